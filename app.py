@@ -1,27 +1,78 @@
-import asyncio
-from fastapi import FastAPI, WebSocket
-from fastapi.responses import HTMLResponse
+import startup  # first: its import time is t=0 for the startup timings
+import asyncio, base64, json
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 import uvicorn
-from datetime import datetime, timedelta, timezone
-from sqlalchemy import func
-from db import init_db, SessionLocal, TrainPass, CarEvent, EngineSighting
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import selectinload
+from db import init_db, run_db, db_executor, SessionLocal, TrainPass, CarEvent, EngineSighting, TrainRollup, TrainCars
+from rollup import backfill_if_empty
+from cache import ResponseCache
+import export
+import metrics
+import preview
 from tracker import event_queue, ocr_queue, tracker_loop
 from ocr_worker import ocr_loop
+from compaction import compaction_loop
 
 from contextlib import asynccontextmanager
 
+async def prepare_db():
+    await asyncio.get_running_loop().run_in_executor(db_executor, init_db)
+    if await run_db(backfill_if_empty):
+        print("Built train_rollup from train_pass history (new rollup, or one with old UNK buckets)")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db()
-    # Kick off background loops
-    asyncio.create_task(tracker_loop())
-    asyncio.create_task(ocr_loop(ocr_queue, event_queue))
+    # Everything starts at once: OCR engines, DB schema, model + warmup, cameras.
+    # OCR goes first so its worker processes fork before the model threads start.
+    startup.expect("db", "ocr")
+    tasks = [asyncio.create_task(ocr_loop(ocr_queue, event_queue))]
+    db_ready = asyncio.create_task(startup.timed("db", prepare_db()))
+    tasks.append(asyncio.create_task(tracker_loop(on_commit=api_cache.on_commit, db_ready=db_ready)))
+    try:
+        # The API needs the schema; the model and cameras keep loading meanwhile
+        await db_ready
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    tasks.append(asyncio.create_task(compaction_loop()))
     yield
+    # Cancel on shutdown so the loops' cleanup (final DB flush, camera release) runs
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 app = FastAPI(lifespan=lifespan)
+
+# REST responses are cached until a tracker/OCR event changes the data behind them
+api_cache = ResponseCache()
+event_queue.add_listener(api_cache.on_event)
+metrics.Gauge("api_cache_hits_total", "REST responses served from the cache.", lambda: api_cache.hits, kind="counter")
+metrics.Gauge("api_cache_misses_total", "REST responses built from the DB.", lambda: api_cache.misses, kind="counter")
+
+async def cached_json(request: Request, tags: set, build):
+    """Serve build(db) as JSON through api_cache, with ETag / If-None-Match → 304 support.
+
+    Cache hits are answered right here; misses run build on the DB executor.
+    """
+    key = (request.url.path, str(request.query_params))
+    entry = api_cache.get(key)
+    if entry is None:
+        gen = api_cache.generation
+        data = await run_db(build)
+        entry = api_cache.put(key, json.dumps(data).encode(), tags, gen)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == entry.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -29,93 +80,286 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+@app.get("/stream.mjpg")
+async def stream_mjpg(camera: Optional[str] = None):
+    """Annotated live preview (boxes, track ids, count line) as MJPEG; open it in a browser or <img>."""
+    hub = preview.previews.get(camera) if camera else next(iter(preview.previews.values()), None)
+    if hub is None:
+        raise HTTPException(404, "No such camera (or the tracker hasn't started yet)")
+    return StreamingResponse(hub.frames(), media_type=f"multipart/x-mixed-replace; boundary={preview.BOUNDARY}",
+                             headers={"Cache-Control": "no-cache"})
+
 @app.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
-    while True:
-        msg = await event_queue.get()
-        await ws.send_json(msg)
+    sub = event_queue.subscribe()
+    try:
+        while True:
+            msg = await sub.get()
+            if msg is None:
+                # Dropped for falling too far behind; the dashboard reconnects and gets a snapshot
+                await ws.close(code=1013)
+                break
+            await ws.send_json(msg)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_queue.unsubscribe(sub)
+
+def _direction_fields(dird: str) -> dict:
+    return {f"trains_{dird}": 0, f"cars_{dird}": 0, f"locomotives_{dird}": 0, f"avg_speed_{dird}": None}
+
+def _by_direction(rows, key: str):
+    """Reshape (bucket, direction, trains, cars, locos, speed_sum, speed_count) rows to one dict per bucket.
+
+    EB/WB fields are always present; NB/SB cameras and trains with no
+    direction ("unknown") get their own *_NB / *_SB / *_unknown fields when
+    they occur in the bucket.
+    """
+    out = {}
+    for bkt, dird, ntr, ncars, nlocos, ssum, scount in rows:
+        if bkt not in out:
+            out[bkt] = {key: bkt, **_direction_fields("EB"), **_direction_fields("WB")}
+        dird = dird or "unknown"
+        if f"trains_{dird}" not in out[bkt]:
+            out[bkt].update(_direction_fields(dird))
+        out[bkt][f"trains_{dird}"] += int(ntr or 0)
+        out[bkt][f"cars_{dird}"] += int(ncars or 0)
+        out[bkt][f"locomotives_{dird}"] += int(nlocos or 0)
+        if scount:
+            out[bkt][f"avg_speed_{dird}"] = round(ssum / scount, 1)
+    return [out[k] for k in sorted(out)]
+
+SUMMARY_MAX_DAYS = 3660        # furthest back the summary endpoints look (~10 years)
+
+def _rollup_query(db, *bucket_cols):
+    return db.query(*bucket_cols, TrainRollup.direction,
+                    func.sum(TrainRollup.trains), func.sum(TrainRollup.cars),
+                    func.sum(TrainRollup.locomotives), func.sum(TrainRollup.speed_sum),
+                    func.sum(TrainRollup.speed_count))
 
 @app.get("/api/summary/daily")
-def summary_daily():
+async def summary_daily(request: Request, days: int = Query(14, ge=1, le=SUMMARY_MAX_DAYS)):
     """
-    Returns last 14 days with per-direction breakdown:
+    Returns last `days` (default 14) days with per-direction breakdown, from the rollup table:
     [
-      {"day":"2026-02-16","trains_EB":3,"trains_WB":2,"cars_EB":210,"cars_WB":175},
+      {"day":"2026-02-16","trains_EB":3,"trains_WB":2,"cars_EB":210,"cars_WB":175, ...},
       ...
     ]
     """
-    db = SessionLocal()
+    return await cached_json(request, {"summary"}, lambda db: _summary_daily(db, days))
+
+def _summary_daily(db, days: int):
+    start = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    rows = (_rollup_query(db, TrainRollup.day)
+              .filter(TrainRollup.day >= start)
+              .group_by(TrainRollup.day, TrainRollup.direction)
+              .all())
+    return {"data": _by_direction(rows, "day")}
+
+@app.get("/api/summary/hourly")
+async def summary_hourly(request: Request, days: int = Query(2, ge=1, le=SUMMARY_MAX_DAYS)):
+    """Per-hour (UTC) breakdown for the last `days` days; "hour" is "YYYY-MM-DDTHH"."""
+    return await cached_json(request, {"summary"}, lambda db: _summary_hourly(db, days))
+
+def _summary_hourly(db, days: int):
+    start = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    rows = (_rollup_query(db, TrainRollup.day, TrainRollup.hour)
+              .filter(TrainRollup.day >= start)
+              .group_by(TrainRollup.day, TrainRollup.hour, TrainRollup.direction)
+              .all())
+    return {"data": _by_direction(
+        ((f"{day}T{hour:02d}", *rest) for day, hour, *rest in rows), "hour")}
+
+@app.get("/api/summary/weekly")
+async def summary_weekly(request: Request, weeks: int = Query(12, ge=1, le=SUMMARY_MAX_DAYS // 7)):
+    """Per-week breakdown for the last `weeks` weeks; "week" is the Monday the week starts on."""
+    return await cached_json(request, {"summary"}, lambda db: _summary_weekly(db, weeks))
+
+def _summary_weekly(db, weeks: int):
+    today = datetime.now(timezone.utc).date()
+    start = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+    rows = (_rollup_query(db, TrainRollup.day)
+              .filter(TrainRollup.day >= start.isoformat())
+              .group_by(TrainRollup.day, TrainRollup.direction)
+              .all())
+
+    def week_of(day: str) -> str:
+        d = datetime.strptime(day, "%Y-%m-%d").date()
+        return (d - timedelta(days=d.weekday())).isoformat()
+
+    # _by_direction sums repeated buckets; speed needs sum/count kept apart, so pre-aggregate
+    weekly = {}
+    for day, dird, ntr, ncars, nlocos, ssum, scount in rows:
+        acc = weekly.setdefault((week_of(day), dird), [0, 0, 0, 0.0, 0])
+        for i, v in enumerate((ntr, ncars, nlocos, ssum, scount)):
+            acc[i] += v or 0
+    return {"data": _by_direction(((wk, dird, *acc) for (wk, dird), acc in weekly.items()), "week")}
+
+TRAINS_PAGE_SIZE = 50          # default /api/trains page size
+TRAINS_MAX_PAGE_SIZE = 500
+
+def _train_row(tp: TrainPass) -> dict:
+    return {
+        "train_id": tp.train_id,
+        "start_ts": tp.start_ts.isoformat(),
+        "end_ts": tp.end_ts.isoformat() if tp.end_ts else None,
+        "direction": tp.direction,
+        "camera": tp.camera,
+        "locomotives": tp.total_locomotives,
+        "railcars": tp.total_railcars,
+        "avg_speed_mph": tp.avg_speed_mph,
+        "engine_numbers": [e.engine_number for e in tp.engines]
+    }
+
+def _encode_cursor(tp: TrainPass) -> str:
+    raw = f"{tp.start_ts.isoformat()}|{tp.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
     try:
-        start = datetime.now(timezone.utc) - timedelta(days=14)
-        # Aggregate trains & cars per day and direction
-        rows = (db.query(func.date(TrainPass.start_ts).label("day"),
-                         TrainPass.direction.label("dir"),
-                         func.count(TrainPass.id).label("trains"),
-                         func.sum(TrainPass.total_railcars).label("cars"))
-                  .filter(TrainPass.start_ts >= start)
-                  .group_by(func.date(TrainPass.start_ts), TrainPass.direction)
-                  .order_by(func.date(TrainPass.start_ts))
-                  .all())
-
-        # reshape to day rows with EB/WB fields
-        by_day = {}
-        for day, dird, ntr, ncars in rows:
-            key = str(day)
-            if key not in by_day:
-                by_day[key] = {"day": key, "trains_EB":0, "trains_WB":0, "cars_EB":0, "cars_WB":0}
-            if dird == "EB":
-                by_day[key]["trains_EB"] = int(ntr or 0)
-                by_day[key]["cars_EB"] = int(ncars or 0)
-            elif dird == "WB":
-                by_day[key]["trains_WB"] = int(ntr or 0)
-                by_day[key]["cars_WB"] = int(ncars or 0)
-
-        # fill gaps with zeros
-        days = sorted(by_day.keys())
-        return {"data": [by_day[d] for d in days]}
-    finally:
-        db.close()
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, pid = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(pid)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor")
 
 @app.get("/api/trains/recent")
-def trains_recent():
-    db = SessionLocal()
-    try:
-        rows = (db.query(TrainPass)
-                  .order_by(TrainPass.start_ts.desc())
-                  .limit(20).all())
-        out = []
-        for tp in rows:
-            engines = [e.engine_number for e in tp.engines]
-            out.append({
-                "train_id": tp.train_id,
-                "start_ts": tp.start_ts.isoformat(),
-                "end_ts": tp.end_ts.isoformat() if tp.end_ts else None,
-                "direction": tp.direction,
-                "locomotives": tp.total_locomotives,
-                "railcars": tp.total_railcars,
-                "avg_speed_mph": tp.avg_speed_mph,
-                "engine_numbers": engines
-            })
-        return {"data": out}
-    finally:
-        db.close()
+async def trains_recent(request: Request):
+    return await cached_json(request, {"trains"}, _trains_recent)
+
+def _trains_recent(db):
+    # Engines come in one extra IN query for the whole page, not one per train
+    rows = (db.query(TrainPass)
+              .options(selectinload(TrainPass.engines))
+              .order_by(TrainPass.start_ts.desc(), TrainPass.id.desc())
+              .limit(20).all())
+    return {"data": [_train_row(tp) for tp in rows]}
+
+@app.get("/api/trains")
+async def trains_history(request: Request, cursor: Optional[str] = None,
+                   limit: int = Query(TRAINS_PAGE_SIZE, ge=1, le=TRAINS_MAX_PAGE_SIZE),
+                   direction: Optional[str] = None, engine: Optional[str] = None,
+                   from_date: Optional[date] = None, to_date: Optional[date] = None,
+                   events: bool = False):
+    """
+    Train history, newest first, keyset-paginated on (start_ts, id):
+    {"data": [...], "next_cursor": "..."}  -- pass next_cursor back as ?cursor= for the next page.
+    Filters: direction (EB/WB), engine number, from_date/to_date (inclusive, UTC).
+    events=true adds per-class/direction car counts (from car_event, or train_cars once compacted).
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    tags = {"trains", "car_events"} if events else {"trains"}
+    return await cached_json(request, tags, lambda db: _trains_history(
+        db, after, limit, direction, engine, from_date, to_date, events))
+
+def _trains_history(db, after, limit, direction, engine, from_date, to_date, events):
+    q = db.query(TrainPass).options(selectinload(TrainPass.engines))
+    if after is not None:
+        ts, pid = after
+        q = q.filter(or_(TrainPass.start_ts < ts,
+                         and_(TrainPass.start_ts == ts, TrainPass.id < pid)))
+    if direction:
+        q = q.filter(TrainPass.direction == direction)
+    if engine:
+        q = q.filter(TrainPass.id.in_(
+            select(EngineSighting.train_pass_id).where(EngineSighting.engine_number == engine)))
+    if from_date:
+        q = q.filter(TrainPass.start_ts >= datetime.combine(from_date, datetime.min.time()))
+    if to_date:
+        q = q.filter(TrainPass.start_ts < datetime.combine(to_date + timedelta(days=1), datetime.min.time()))
+    # One row past the page tells us whether there is a next page
+    rows = q.order_by(TrainPass.start_ts.desc(), TrainPass.id.desc()).limit(limit + 1).all()
+    page, more = rows[:limit], len(rows) > limit
+
+    out = [_train_row(tp) for tp in page]
+    if events and page:
+        # Car-event summary for the whole page in one grouped query
+        counts = (db.query(CarEvent.train_pass_id, CarEvent.klass, CarEvent.direction,
+                           func.count(CarEvent.id))
+                    .filter(CarEvent.train_pass_id.in_([tp.id for tp in page]))
+                    .group_by(CarEvent.train_pass_id, CarEvent.klass, CarEvent.direction)
+                    .all())
+        by_pass = {}
+        for pid, klass, dird, n in counts:
+            by_pass.setdefault(pid, {})[klass, dird] = int(n)
+        # Older trains were compacted: their summary lives on train_cars
+        packed = (db.query(TrainCars.train_pass_id, TrainCars.summary)
+                    .filter(TrainCars.train_pass_id.in_([tp.id for tp in page])).all())
+        for pid, summary in packed:
+            per = by_pass.setdefault(pid, {})
+            for c in summary or []:
+                per[c["class"], c["direction"]] = per.get((c["class"], c["direction"]), 0) + c["count"]
+        for row, tp in zip(out, page):
+            row["car_events"] = [{"class": k, "direction": d, "count": n}
+                                 for (k, d), n in by_pass.get(tp.id, {}).items()]
+
+    return {"data": out, "next_cursor": _encode_cursor(page[-1]) if more else None}
 
 @app.get("/api/engines/by_direction")
-def engines_by_direction():
+async def engines_by_direction(request: Request):
+    return await cached_json(request, {"engines"}, _engines_by_direction)
+
+def _engines_by_direction(db):
+    start = datetime.utcnow() - timedelta(days=30)
+    rows = (db.query(EngineSighting.engine_number, TrainPass.direction, func.count(EngineSighting.id))
+              .join(TrainPass, EngineSighting.train_pass_id == TrainPass.id)
+              .filter(TrainPass.start_ts >= start, TrainPass.direction.in_(["EB","WB"]))
+              .group_by(EngineSighting.engine_number, TrainPass.direction)
+              .order_by(EngineSighting.engine_number, TrainPass.direction)
+              .all())
+    data = [{"engine": r[0], "direction": r[1], "count": int(r[2])} for r in rows]
+    return {"data": data}
+
+@app.get("/api/export/{table}")
+async def export_table(table: str, format: str = "ndjson",
+                       from_date: Optional[date] = None, to_date: Optional[date] = None):
+    """Stream a whole table (train_passes, car_events, engine_sightings) as NDJSON, CSV or Parquet.
+
+    Rows are read and encoded export.EXPORT_CHUNK at a time on the DB executor,
+    so the response starts immediately and memory doesn't grow with the range.
+    """
+    if table not in export.TABLES:
+        raise HTTPException(404, f"Unknown table {table!r}; choose from {', '.join(export.TABLES)}")
+    if format not in export.FORMATS:
+        raise HTTPException(400, f"Unknown format {format!r}; choose from {', '.join(export.FORMATS)}")
+    if format == "parquet" and not export.parquet_available():
+        raise HTTPException(400, "Parquet export needs pyarrow on the server")
+    media_type, ext = export.FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="{table}.{ext}"'}
+    return StreamingResponse(_export_body(table, format, from_date, to_date),
+                             media_type=media_type, headers=headers)
+
+async def _export_body(table, fmt, from_date, to_date):
+    loop = asyncio.get_running_loop()
     db = SessionLocal()
+    chunks = export.export_stream(db, table, fmt, from_date, to_date)
     try:
-        start = datetime.utcnow() - timedelta(days=30)
-        rows = (db.query(EngineSighting.engine_number, TrainPass.direction, func.count(EngineSighting.id))
-                  .join(TrainPass, EngineSighting.train_pass_id == TrainPass.id)
-                  .filter(TrainPass.start_ts >= start, TrainPass.direction.in_(["EB","WB"]))
-                  .group_by(EngineSighting.engine_number, TrainPass.direction)
-                  .order_by(EngineSighting.engine_number, TrainPass.direction)
-                  .all())
-        data = [{"engine": r[0], "direction": r[1], "count": int(r[2])} for r in rows]
-        return {"data": data}
+        while True:
+            data = await loop.run_in_executor(db_executor, next, chunks, None)
+            if data is None:
+                break
+            yield data
     finally:
-        db.close()
+        # Closing the generator releases the DB cursor; both touch the connection, so not on the loop
+        await loop.run_in_executor(db_executor, chunks.close)
+        await loop.run_in_executor(db_executor, db.close)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the server is up and answering (the pipeline may still be starting)."""
+    return {"status": "ok", "uptime_s": startup.status()["uptime_s"]}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once every subsystem is ready, else 503. Body has per-subsystem
+    state and startup timings (seconds since process start) and first_counted_frame_s."""
+    st = startup.status()
+    return JSONResponse(st, status_code=200 if st["ready"] else 503)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""Throughput + counting regression benchmark over a corpus of recorded clips.
+
+The corpus directory holds the clips (video files or frame directories) and an
+expected.json with the known counts for each one:
+
+    {
+      "eb_mixed_62.mp4": {"locomotive": 3, "railcar": 59},
+      "wb_frames_0412": {"locomotive": 2, "railcar": 118, "source_fps": 15}
+    }
+
+    python benchmark.py clips/ --out bench.json
+    python benchmark.py clips/ --baseline bench.json   # fail if fps regressed
+    python benchmark.py clips/ --backends pytorch,onnx,openvino   # fps per inference backend
+
+Exits non-zero if any clip's counts differ from expected or, with --baseline,
+if a clip's fps dropped by more than --tolerance.
+"""
+import argparse, json, os, sys
+
+import tracker
+from replay import parse_roi, replay
+from tracker import load_model
+
+EXPECTED_FILE = "expected.json"
+
+def run_corpus(corpus: str, model, fps=None, roi=tracker.ROI) -> list:
+    with open(os.path.join(corpus, EXPECTED_FILE)) as f:
+        expected = json.load(f)
+
+    results = []
+    for name in sorted(expected):
+        exp = expected[name]
+        res = replay(os.path.join(corpus, name), model, fps=fps,
+                     source_fps=exp.get("source_fps"), roi=roi)
+        res["clip"] = name
+        res["expected"] = {"locomotive": exp.get("locomotive", 0), "railcar": exp.get("railcar", 0)}
+        res["counts_ok"] = res["totals"] == res["expected"]
+        results.append(res)
+    return results
+
+def compare_baseline(results: list, baseline: list, tolerance: float) -> list:
+    """Return (clip, old_fps, new_fps) for clips that got slower than the tolerance allows."""
+    old = {r["clip"]: r["fps"] for r in baseline}
+    slower = []
+    for r in results:
+        if r["clip"] in old and r["fps"] < old[r["clip"]] * (1.0 - tolerance):
+            slower.append((r["clip"], old[r["clip"]], r["fps"]))
+    return slower
+
+def print_table(results: list):
+    print(f"{'clip':<28} {'fps':>7} {'inf p50':>8} {'inf p99':>8} {'cnt p99':>8}  counts (got / expected)")
+    for r in results:
+        lat = r["latency_ms"]
+        got, exp = r["totals"], r["expected"]
+        mark = "ok" if r["counts_ok"] else "MISMATCH"
+        print(f"{r['clip']:<28} {r['fps']:>7} {lat['inference']['p50']!s:>8} "
+              f"{lat['inference']['p99']!s:>8} {lat['counting']['p99']!s:>8}  "
+              f"{got['locomotive']}L/{got['railcar']}R / {exp['locomotive']}L/{exp['railcar']}R {mark}")
+
+def print_backends(by_backend: dict):
+    """fps per clip and backend, side by side."""
+    names = list(by_backend)
+    print(f"{'clip':<28} " + " ".join(f"{b:>14}" for b in names))
+    clips = [r["clip"] for r in next(iter(by_backend.values()))]
+    for i, clip in enumerate(clips):
+        cells = []
+        for b in names:
+            r = by_backend[b][i]
+            cells.append(f"{r['fps']:>11}{'' if r['counts_ok'] else ' !!':>3}")
+        print(f"{clip:<28} " + " ".join(cells))
+    print("(!! = counts differ from expected)")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark tracker throughput and counts over a clip corpus.")
+    ap.add_argument("corpus", help=f"directory containing clips and {EXPECTED_FILE}")
+    ap.add_argument("--model", default=tracker.MODEL_PATH)
+    ap.add_argument("--backend", default=tracker.INFERENCE_BACKEND, choices=list(tracker.EXPORT_FORMATS))
+    ap.add_argument("--backends", help="comma-separated backends to compare on the same corpus")
+    ap.add_argument("--fps", type=float, default=None, help="simulated live fps (default: as fast as possible)")
+    ap.add_argument("--roi", type=parse_roi, default=tracker.ROI, help="x1,y1,x2,y2 region to run YOLO on")
+    ap.add_argument("--out", help="write full results as JSON")
+    ap.add_argument("--baseline", help="previous --out file to compare fps against")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed fractional fps drop vs baseline")
+    args = ap.parse_args()
+
+    if args.backends:
+        by_backend = {b: run_corpus(args.corpus, load_model(args.model, backend=b), fps=args.fps, roi=args.roi)
+                      for b in args.backends.split(",")}
+        print_backends(by_backend)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(by_backend, f, indent=2)
+        sys.exit(0 if all(r["counts_ok"] for rs in by_backend.values() for r in rs) else 1)
+
+    results = run_corpus(args.corpus, load_model(args.model, backend=args.backend), fps=args.fps, roi=args.roi)
+    print_table(results)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = not all(r["counts_ok"] for r in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare_baseline(results, json.load(f), args.tolerance)
+        for clip, old_fps, new_fps in slower:
+            print(f"fps regression: {clip} {old_fps} -> {new_fps}")
+        failed = failed or bool(slower)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+from collections import deque
+from typing import Optional
+
+# CONFIG
+SUBSCRIBER_QUEUE_SIZE = 100    # pending events per /ws client before coalescing / dropping it
+
+class Subscriber:
+    """One client's bounded event queue."""
+    def __init__(self, maxsize: int = SUBSCRIBER_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.closed = False
+        self._q = deque()
+        self._ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._q)
+
+    def offer(self, ev: dict) -> bool:
+        """Queue an event without waiting. False if the client is too far behind even after coalescing."""
+        if len(self._q) >= self.maxsize:
+            self._coalesce()
+            if len(self._q) >= self.maxsize:
+                return False
+        self._q.append(ev)
+        self._ready.set()
+        return True
+
+    def _coalesce(self):
+        # "count" totals are cumulative, so only the newest one per train still matters
+        seen = set()
+        kept = deque()
+        for ev in reversed(self._q):
+            if ev.get("event") == "count":
+                if ev.get("train_id") in seen:
+                    continue
+                seen.add(ev.get("train_id"))
+            kept.appendleft(ev)
+        self._q = kept
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get(self) -> Optional[dict]:
+        """Next event, or None once the subscriber has been dropped."""
+        while not self._q:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        return self._q.popleft()
+
+class Broadcaster:
+    """Pub/sub hub between the tracker/OCR loops and the /ws clients.
+
+    Publishers call put()/put_nowait() exactly like they did on the old shared
+    asyncio.Queue; every subscriber receives every event on its own bounded
+    queue. Publishing never waits: a slow client first has its superseded
+    "count" events coalesced and is dropped if it is still full. The hub keeps
+    a snapshot of every active train (one per camera at most) so late joiners
+    can catch up.
+    """
+    def __init__(self, maxsize: int = SUBSCRIBER_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.listeners = []   # sync callbacks run on every publish (e.g. cache invalidation)
+        self.dropped_clients = 0
+        self.active_trains = {}   # train_id -> live state
+
+    def subscribe(self) -> Subscriber:
+        sub = Subscriber(self.maxsize)
+        for snap in self.snapshots():
+            sub.offer(snap)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self.subscribers.discard(sub)
+        sub.close()
+
+    def snapshots(self) -> list:
+        return [{"event": "snapshot", **t, "totals": dict(t["totals"]),
+                 "engine_numbers": sorted(t["engine_numbers"])}
+                for t in self.active_trains.values()]
+
+    def _track_state(self, ev: dict):
+        kind = ev.get("event")
+        if kind == "train_start":
+            self.active_trains[ev["train_id"]] = {
+                "train_id": ev["train_id"], "camera": ev.get("camera"), "ts": ev.get("ts"), "totals": {},
+                "speed_mph": None, "avg_speed_mph": None, "engine_numbers": set()}
+            return
+        t = self.active_trains.get(ev.get("train_id"))
+        if t is None:
+            return
+        if kind == "count":
+            t["totals"] = ev.get("totals", {})
+            t["speed_mph"] = ev.get("speed_mph")
+            t["avg_speed_mph"] = ev.get("avg_speed_mph")
+        elif kind == "engine_number":
+            t["engine_numbers"].add(ev["engine_number"])
+        elif kind == "train_end":
+            del self.active_trains[ev["train_id"]]
+
+    def add_listener(self, fn):
+        self.listeners.append(fn)
+
+    def put_nowait(self, ev: dict):
+        self._track_state(ev)
+        for fn in self.listeners:
+            fn(ev)
+        for sub in list(self.subscribers):
+            if not sub.offer(ev):
+                # Client can't keep up: drop it rather than make the tracker wait
+                self.dropped_clients += 1
+                self.unsubscribe(sub)
+
+    async def put(self, ev: dict):
+        self.put_nowait(ev)
+
+    def qsize(self) -> int:
+        """Deepest subscriber backlog."""
+        return max((s.qsize() for s in self.subscribers), default=0)
@@ -0,0 +1,88 @@
+import hashlib, threading, time
+from collections import OrderedDict
+from typing import Optional
+
+# CONFIG
+CACHE_TTL_S = 60.0             # upper bound on staleness if an invalidation is ever missed
+CACHE_MAX_ENTRIES = 128
+
+# Which tracker/OCR events change which cached responses
+INVALIDATED_BY = {
+    "train_start": {"trains"},
+    "train_end": {"summary", "trains", "engines"},
+    "engine_number": {"trains", "engines"},
+    "count": {"car_events"},   # only /api/trains?events=true shows per-car counts
+}
+# PersistenceWriter op kinds -> the event they make visible in the DB
+COMMIT_EVENTS = {"start": "train_start", "car": "count", "end": "train_end"}
+
+class CacheEntry:
+    __slots__ = ("body", "etag", "tags", "expires")
+
+    def __init__(self, body: bytes, tags: set, ttl: float):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.tags = tags
+        self.expires = time.monotonic() + ttl
+
+class ResponseCache:
+    """Serialized API responses keyed by path + query, tagged by what data they depend on.
+
+    Entries are dropped when a tracker/OCR event touching one of their tags is
+    published (and again when the write-behind writer commits it, since the
+    event can reach us before the row is in the DB), after CACHE_TTL_S, or
+    least-recently-used first past CACHE_MAX_ENTRIES. Thread-safe: endpoints
+    are async and read/fill it on the event loop (building misses with
+    run_db on db_executor), but commits arrive from the writer thread.
+    """
+    def __init__(self, ttl: float = CACHE_TTL_S, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self.generation = 0   # bumped on every invalidation
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body: bytes, tags: set, generation: Optional[int] = None) -> CacheEntry:
+        """Store a response. Pass the generation read before querying: if an
+        invalidation happened meanwhile the body may be stale and isn't kept."""
+        entry = CacheEntry(body, set(tags), self.ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, tags: set):
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, e in self._entries.items() if e.tags & tags]:
+                del self._entries[key]
+
+    def on_event(self, ev: dict):
+        """Broadcaster listener."""
+        tags = INVALIDATED_BY.get(ev.get("event"))
+        if tags:
+            self.invalidate(tags)
+
+    def on_commit(self, kinds: set):
+        """PersistenceWriter hook, called from the writer thread after each commit."""
+        for kind in kinds:
+            self.on_event({"event": COMMIT_EVENTS.get(kind)})
+
+    def __len__(self) -> int:
+        return len(self._entries)
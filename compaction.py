@@ -0,0 +1,145 @@
+"""Retention for car_event: fold old trains' per-car rows into one packed train_cars record.
+
+A busy line adds hundreds of thousands of car_event rows a month. Once a
+train is older than COMPACT_AFTER_DAYS its rows are packed into a single
+TrainCars row (a zlib'd array of crossing offsets, track ids, classes and
+directions, plus the per-class/direction summary /api/trains needs) and
+deleted. TrainPass totals and the rollup table are untouched. Freed pages
+go back to the filesystem with PRAGMA incremental_vacuum.
+
+The job runs in small transactions on the DB executor, so the tracker's
+writer only ever waits for one short batch.
+
+    python compaction.py                 # compact + vacuum once, now
+    python compaction.py --convert       # one-off: switch an existing DB to incremental auto_vacuum (offline!)
+"""
+import argparse, asyncio, os, zlib
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import text
+
+from db import engine, run_db, TrainPass, CarEvent, TrainCars
+
+# CONFIG
+COMPACT_AFTER_DAYS = int(os.environ.get("COMPACT_AFTER_DAYS", 90))   # 0 disables the background job
+COMPACT_INTERVAL_S = 6 * 3600  # how often the background job looks for work
+COMPACT_BATCH_TRAINS = 20      # trains per transaction
+COMPACT_PAUSE_S = 0.5          # breather between batches for the live writer
+VACUUM_PAGES = 2000            # pages released per incremental_vacuum step
+
+PACKED_DTYPE = np.dtype([("offset_ms", "<i4"), ("track_id", "<i4"), ("cls", "u1"), ("dir", "u1")])
+
+def pack_events(start_ts: datetime, events: list) -> dict:
+    """TrainCars fields for a train's CarEvents (in crossing order)."""
+    classes, dirs = [], []
+    arr = np.zeros(len(events), dtype=PACKED_DTYPE)
+    for i, ev in enumerate(events):
+        if ev.klass not in classes:
+            classes.append(ev.klass)
+        if ev.direction not in dirs:
+            dirs.append(ev.direction)
+        arr[i] = ((ev.crossed_ts - start_ts) // timedelta(milliseconds=1) if ev.crossed_ts and start_ts else -1,
+                  ev.track_id if ev.track_id is not None else -1,
+                  classes.index(ev.klass), dirs.index(ev.direction))
+    summary = Counter((ev.klass, ev.direction) for ev in events)
+    return {"n_cars": len(events),
+            "labels": {"class": classes, "direction": dirs},
+            "summary": [{"class": k, "direction": d, "count": n} for (k, d), n in sorted(summary.items(), key=str)],
+            "packed": zlib.compress(arr.tobytes())}
+
+def unpack(tc: TrainCars, start_ts: Optional[datetime]) -> list:
+    """The packed cars back as dicts (track_id, class, direction, crossed_ts)."""
+    arr = np.frombuffer(zlib.decompress(tc.packed), dtype=PACKED_DTYPE)
+    classes, dirs = tc.labels["class"], tc.labels["direction"]
+    out = []
+    for off, tid, c, d in arr.tolist():
+        out.append({"track_id": None if tid < 0 else tid, "class": classes[c], "direction": dirs[d],
+                    "crossed_ts": start_ts + timedelta(milliseconds=off) if off >= 0 and start_ts else None})
+    return out
+
+def compact_trains(db, cutoff: datetime, limit: int = COMPACT_BATCH_TRAINS) -> int:
+    """Pack the car_event rows of up to `limit` trains that ended before cutoff; returns trains done."""
+    ids = [pid for (pid,) in db.query(CarEvent.train_pass_id)
+                                .join(TrainPass, CarEvent.train_pass_id == TrainPass.id)
+                                .filter(TrainPass.end_ts.isnot(None), TrainPass.end_ts < cutoff)
+                                .distinct().limit(limit)]
+    for pid in ids:
+        tp = db.get(TrainPass, pid)
+        events = (db.query(CarEvent).filter(CarEvent.train_pass_id == pid)
+                    .order_by(CarEvent.crossed_ts, CarEvent.id).all())
+        tc = tp.packed_cars
+        if tc is not None:
+            # Stragglers written after an earlier compaction: merge them in
+            old = [CarEvent(track_id=c["track_id"], klass=c["class"], direction=c["direction"],
+                            crossed_ts=c["crossed_ts"]) for c in unpack(tc, tp.start_ts)]
+            events = old + events
+        else:
+            tc = tp.packed_cars = TrainCars()
+        for k, v in pack_events(tp.start_ts, events).items():
+            setattr(tc, k, v)
+        db.query(CarEvent).filter(CarEvent.train_pass_id == pid).delete(synchronize_session=False)
+    db.commit()
+    return len(ids)
+
+def incremental_vacuum(db, pages: int = VACUUM_PAGES) -> int:
+    """Give up to `pages` free pages back to the filesystem; returns the free pages left."""
+    if not engine.url.get_backend_name() == "sqlite":
+        return 0
+    if db.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+        return 0   # not in incremental mode (see --convert)
+    # The pragma frees one page per step, and sqlite3's execute() only steps a statement
+    # without result columns once; executescript() runs it to completion
+    db.connection().connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    db.commit()
+    return int(db.execute(text("PRAGMA freelist_count")).scalar())
+
+async def compact_once(days: int = COMPACT_AFTER_DAYS) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    total = 0
+    while True:
+        n = await run_db(compact_trains, cutoff)
+        total += n
+        if n < COMPACT_BATCH_TRAINS:
+            break
+        await asyncio.sleep(COMPACT_PAUSE_S)
+    free, last = await run_db(incremental_vacuum), None
+    while 0 < free and free != last:
+        await asyncio.sleep(COMPACT_PAUSE_S)
+        free, last = await run_db(incremental_vacuum), free
+    return total
+
+async def compaction_loop():
+    if COMPACT_AFTER_DAYS <= 0:
+        return
+    while True:
+        try:
+            n = await compact_once()
+            if n:
+                print(f"Compaction: packed car events of {n} trains older than {COMPACT_AFTER_DAYS} days")
+        except Exception as e:
+            print(f"Compaction failed: {e}")
+        await asyncio.sleep(COMPACT_INTERVAL_S)
+
+def convert_to_incremental():
+    """Existing databases need one full VACUUM to switch auto_vacuum mode. Blocks all writers; run it offline."""
+    with engine.connect() as conn:
+        conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+        print(f"auto_vacuum is now {conn.execute(text('PRAGMA auto_vacuum')).scalar()} (2 = incremental)")
+
+def main():
+    ap = argparse.ArgumentParser(description="Compact old car events and vacuum the database.")
+    ap.add_argument("--days", type=int, default=COMPACT_AFTER_DAYS or 90, help="compact trains older than this")
+    ap.add_argument("--convert", action="store_true",
+                    help="switch an existing SQLite DB to incremental auto_vacuum (full VACUUM; stop the app first)")
+    args = ap.parse_args()
+    if args.convert:
+        convert_to_incremental()
+    n = asyncio.run(compact_once(args.days))
+    print(f"Packed car events of {n} trains older than {args.days} days")
+
+if __name__ == "__main__":
+    main()
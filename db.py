@@ -1,13 +1,56 @@
-from sqlalchemy import (create_engine, Column, Integer, String, Float, DateTime,
-                        ForeignKey, JSON)
+import asyncio, functools, os
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import (create_engine, event, Column, Integer, String, Float, DateTime,
+                        ForeignKey, JSON, LargeBinary, UniqueConstraint, Index, inspect, text)
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from datetime import datetime, timezone
 
-DB_URL = "sqlite:///train_counter.db"
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+# CONFIG
+DB_URL = os.environ.get("DB_URL", "sqlite:///train_counter.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+SQLITE_CACHE_KB = 16384        # page cache per connection
+SQLITE_BUSY_TIMEOUT_MS = 5000  # wait this long on a locked DB instead of failing
+
+_is_sqlite = DB_URL.startswith("sqlite")
+engine = create_engine(
+    DB_URL,
+    connect_args={"check_same_thread": False} if _is_sqlite else {},
+    pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE, pool_pre_ping=True,
+)
+
+if _is_sqlite:
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: readers never block the writer (and vice versa); NORMAL sync is safe under WAL
+        cur = dbapi_conn.cursor()
+        # Only takes effect on a new database (existing ones: python compaction.py --convert)
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
+# All DB work from async code goes through this executor, never the event loop thread.
+# One thread per pooled connection, so executor jobs don't queue on the pool.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+def _with_session(fn, *args, **kwargs):
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+async def run_db(fn, *args, **kwargs):
+    """Run fn(db, *args, **kwargs) with a fresh session on db_executor and return its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(_with_session, fn, *args, **kwargs))
+
 class TrainPass(Base):
     __tablename__ = "train_pass"
     id = Column(Integer, primary_key=True)
@@ -18,15 +61,20 @@ class TrainPass(Base):
     total_locomotives = Column(Integer, default=0)
     total_railcars = Column(Integer, default=0)
     avg_speed_mph = Column(Float, nullable=True)
+    camera = Column(String, nullable=True)  # CameraStream name the pass was counted on
     extra = Column(JSON, default={})  # room for future metadata
 
     events = relationship("CarEvent", back_populates="train_pass", cascade="all,delete-orphan")
     engines = relationship("EngineSighting", back_populates="train_pass", cascade="all,delete-orphan")
+    packed_cars = relationship("TrainCars", uselist=False, cascade="all,delete-orphan")
+
+    # Keyset pagination order for /api/trains
+    __table_args__ = (Index("ix_train_pass_start_ts_id", "start_ts", "id"),)
 
 class CarEvent(Base):
     __tablename__ = "car_event"
     id = Column(Integer, primary_key=True)
-    train_pass_id = Column(Integer, ForeignKey("train_pass.id"))
+    train_pass_id = Column(Integer, ForeignKey("train_pass.id"), index=True)
     track_id = Column(Integer)
     klass = Column(String)      # "locomotive" or "railcar"
     crossed_ts = Column(DateTime, default=lambda: datetime.now(timezone.utc))
@@ -37,12 +85,50 @@ class CarEvent(Base):
 class EngineSighting(Base):
     __tablename__ = "engine_sighting"
     id = Column(Integer, primary_key=True)
-    train_pass_id = Column(Integer, ForeignKey("train_pass.id"))
+    train_pass_id = Column(Integer, ForeignKey("train_pass.id"), index=True)
     track_id = Column(Integer)
     engine_number = Column(String, index=True)  # "####"
     first_seen_ts = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
     train_pass = relationship("TrainPass", back_populates="engines")
 
+class TrainCars(Base):
+    """An old train's car_event rows folded into one packed record (see compaction.py)."""
+    __tablename__ = "train_cars"
+    id = Column(Integer, primary_key=True)
+    train_pass_id = Column(Integer, ForeignKey("train_pass.id"), unique=True, index=True)
+    n_cars = Column(Integer, default=0)
+    labels = Column(JSON)       # {"class": [...], "direction": [...]} vocabularies the packed codes index
+    summary = Column(JSON)      # [{"class", "direction", "count"}], same shape as /api/trains car_events
+    packed = Column(LargeBinary)
+
+class TrainRollup(Base):
+    """Per (UTC day, hour, direction) totals, maintained as trains end (see rollup.py)."""
+    __tablename__ = "train_rollup"
+    id = Column(Integer, primary_key=True)
+    day = Column(String, nullable=False)        # "YYYY-MM-DD" (UTC)
+    hour = Column(Integer, nullable=False)      # 0-23 (UTC)
+    direction = Column(String, nullable=False)  # "EB", "WB", "NB", "SB" or "unknown"
+    trains = Column(Integer, default=0)
+    cars = Column(Integer, default=0)
+    locomotives = Column(Integer, default=0)
+    speed_sum = Column(Float, default=0.0)
+    speed_count = Column(Integer, default=0)
+
+    __table_args__ = (UniqueConstraint("day", "hour", "direction", name="uq_rollup_bucket"),)
+
 def init_db():
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    Base.metadata.create_all(engine)
+    # create_all skips tables that already exist; add (nullable) columns introduced since then
+    insp = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name not in have:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} "
+                                      f"{col.type.compile(engine.dialect)}"))
+    # create_all skips tables that already exist; add indexes introduced since then
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(engine, checkfirst=True)
\ No newline at end of file
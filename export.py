@@ -0,0 +1,212 @@
+"""Streaming bulk export of train_pass / car_event / engine_sighting rows.
+
+Rows come off the DB in EXPORT_CHUNK-sized partitions of a streamed result
+and are encoded chunk by chunk, so memory stays flat however long the date
+range is. Used by the /api/export endpoints and from the command line:
+
+    python export.py car_events --format csv --from 2026-01-01 --to 2026-01-31 -o jan.csv
+    python export.py train_passes --format parquet -o trains.parquet
+
+Parquet needs pyarrow (optional; not in requirements.txt).
+"""
+import argparse, csv, io, json, sys
+from datetime import date, datetime, timedelta
+from typing import Optional
+from sqlalchemy import select
+from db import SessionLocal, TrainPass, CarEvent, EngineSighting, TrainCars
+
+# CONFIG
+EXPORT_CHUNK = 5000            # rows fetched, encoded and sent per step (also the Parquet row group size)
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# table -> (columns as (name, expression, kind), timestamp column for date filters, joins)
+TABLES = {
+    "train_passes": ([
+        ("id", TrainPass.id, "int"),
+        ("train_id", TrainPass.train_id, "str"),
+        ("camera", TrainPass.camera, "str"),
+        ("start_ts", TrainPass.start_ts, "ts"),
+        ("end_ts", TrainPass.end_ts, "ts"),
+        ("direction", TrainPass.direction, "str"),
+        ("locomotives", TrainPass.total_locomotives, "int"),
+        ("railcars", TrainPass.total_railcars, "int"),
+        ("avg_speed_mph", TrainPass.avg_speed_mph, "float"),
+    ], TrainPass.start_ts, None),
+    "car_events": ([
+        ("id", CarEvent.id, "int"),
+        ("train_id", TrainPass.train_id, "str"),
+        ("track_id", CarEvent.track_id, "int"),
+        ("class", CarEvent.klass, "str"),
+        ("direction", CarEvent.direction, "str"),
+        ("crossed_ts", CarEvent.crossed_ts, "ts"),
+    ], CarEvent.crossed_ts, (TrainPass, CarEvent.train_pass_id == TrainPass.id)),
+    "engine_sightings": ([
+        ("id", EngineSighting.id, "int"),
+        ("train_id", TrainPass.train_id, "str"),
+        ("track_id", EngineSighting.track_id, "int"),
+        ("engine_number", EngineSighting.engine_number, "str"),
+        ("first_seen_ts", EngineSighting.first_seen_ts, "ts"),
+    ], EngineSighting.first_seen_ts, (TrainPass, EngineSighting.train_pass_id == TrainPass.id)),
+}
+
+def iter_chunks(db, table: str, from_date: Optional[date] = None, to_date: Optional[date] = None,
+                chunk: int = EXPORT_CHUNK):
+    """Yield lists of row tuples, in id order, at most `chunk` rows each. Dates are inclusive (UTC)."""
+    if table == "car_events":
+        yield from _packed_car_chunks(db, from_date, to_date, chunk)
+    cols, ts_col, join = TABLES[table]
+    stmt = select(*[c for _, c, _ in cols])
+    if join is not None:
+        stmt = stmt.join(*join)
+    if from_date:
+        stmt = stmt.where(ts_col >= datetime.combine(from_date, datetime.min.time()))
+    if to_date:
+        stmt = stmt.where(ts_col < datetime.combine(to_date + timedelta(days=1), datetime.min.time()))
+    stmt = stmt.order_by(cols[0][1]).execution_options(stream_results=True)
+    result = db.execute(stmt)
+    try:
+        for part in result.partitions(chunk):
+            yield part
+    finally:
+        result.close()
+
+def _packed_car_chunks(db, from_date, to_date, chunk):
+    """Cars of compacted trains (train_cars), unpacked back into car_events rows with id None."""
+    from compaction import unpack
+    lo = datetime.combine(from_date, datetime.min.time()) if from_date else None
+    hi = datetime.combine(to_date + timedelta(days=1), datetime.min.time()) if to_date else None
+    q = (db.query(TrainCars, TrainPass.train_id, TrainPass.start_ts)
+           .join(TrainPass, TrainCars.train_pass_id == TrainPass.id))
+    # A train's cars cross within its start/end, so the pass times narrow the scan
+    if lo:
+        q = q.filter(TrainPass.end_ts >= lo)
+    if hi:
+        q = q.filter(TrainPass.start_ts < hi)
+    part = []
+    for tc, train_id, start_ts in q.order_by(TrainCars.train_pass_id).yield_per(100):
+        for c in unpack(tc, start_ts):
+            ts = c["crossed_ts"]
+            if (lo and (ts is None or ts < lo)) or (hi and (ts is None or ts >= hi)):
+                continue
+            part.append((None, train_id, c["track_id"], c["class"], c["direction"], ts))
+            if len(part) >= chunk:
+                yield part
+                part = []
+    if part:
+        yield part
+
+def _plain(v):
+    return v.isoformat() if isinstance(v, datetime) else v
+
+def encode_ndjson(names, chunks):
+    for part in chunks:
+        yield "".join(json.dumps(dict(zip(names, map(_plain, row)))) + "\n" for row in part).encode()
+
+def encode_csv(names, chunks):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(names)
+    for part in chunks:
+        w.writerows([[_plain(v) for v in row] for row in part])
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last take()."""
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+        self.closed = False
+
+    def write(self, b) -> int:
+        b = bytes(b)
+        self._parts.append(b)
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts.clear()
+        return out
+
+def encode_parquet(names, kinds, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "ts": pa.timestamp("us")}
+    schema = pa.schema([(n, types[k]) for n, k in zip(names, kinds)])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for part in chunks:
+            # One row group per chunk; only this chunk is ever held as columns
+            cols = list(zip(*part))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(list(c), type=f.type) for c, f in zip(cols, schema)], schema=schema))
+            data = sink.take()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.take()
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def export_stream(db, table: str, fmt: str, from_date: Optional[date] = None,
+                  to_date: Optional[date] = None):
+    """Generator of encoded bytes for one table export."""
+    cols = TABLES[table][0]
+    names = [n for n, _, _ in cols]
+    chunks = iter_chunks(db, table, from_date, to_date)
+    if fmt == "ndjson":
+        return encode_ndjson(names, chunks)
+    if fmt == "csv":
+        return encode_csv(names, chunks)
+    if fmt == "parquet":
+        return encode_parquet(names, [k for _, _, k in cols], chunks)
+    raise ValueError(f"Unknown export format {fmt!r}")
+
+def main():
+    ap = argparse.ArgumentParser(description="Stream a table out of the train database.")
+    ap.add_argument("table", choices=list(TABLES))
+    ap.add_argument("--format", default="ndjson", choices=list(FORMATS))
+    ap.add_argument("--from", dest="from_date", type=date.fromisoformat, help="first day (UTC), inclusive")
+    ap.add_argument("--to", dest="to_date", type=date.fromisoformat, help="last day (UTC), inclusive")
+    ap.add_argument("-o", "--out", help="output file (default: stdout)")
+    args = ap.parse_args()
+
+    if args.format == "parquet" and not parquet_available():
+        sys.exit("Parquet export needs pyarrow: pip install pyarrow")
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    db = SessionLocal()
+    try:
+        for data in export_stream(db, args.table, args.format, args.from_date, args.to_date):
+            out.write(data)
+    finally:
+        db.close()
+        if args.out:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""Detection journal: the tracker's per-frame output on disk, so counting can be re-run without YOLO.
+
+With JOURNAL_DIR set, every frame that reaches the counting stage (timestamp,
+detection count and the confirmed tracks' ids, classes, confidences and
+boxes) is buffered per camera and written out as a segment when the train
+ends, and every JOURNAL_MAX_FRAMES frames before that, so a crash mid-train
+loses at most one chunk. A segment is a directory of plain .npy columns,
+memory-mapped on read:
+
+    journal/<camera>/<YYYYmmdd_HHMMSS_micro>/
+        meta.json     camera settings (line, ROI, ...) and whether it starts on a fresh TrainSession
+        ts.npy        float64[frames]   capture time
+        n_det.npy     uint16[frames]    raw detections (drives START_FRAMES)
+        offsets.npy   int64[frames+1]   box range of each frame
+        track_id.npy  int32[boxes]
+        cls.npy       uint8[boxes]
+        conf.npy      float16[boxes]
+        xyxy.npy      float32[boxes, 4] frame coordinates
+
+Re-score with different counting parameters:
+
+    python journal.py journal/ --line-x 300 --start-frames 4 --end-timeout 10
+    python journal.py journal/ --check      # fast replay vs --exact, non-zero exit on any difference
+"""
+import argparse, json, os, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+# CONFIG
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR")   # unset = journal off
+JOURNAL_MAX_FRAMES = 1800      # also cut a segment after this many frames (~1 min at 30 fps)
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+class JournalWriter:
+    """Buffers one camera's frames and writes a segment per train (or per chunk) on a background thread."""
+    def __init__(self, root: str, camera: str, meta: dict, max_frames: int = JOURNAL_MAX_FRAMES):
+        self.dir = os.path.join(root, camera)
+        self.meta = {"version": 1, "camera": camera, **meta}
+        self.max_frames = max_frames
+        self._fresh = True    # the next segment starts on a fresh TrainSession
+        self._reset()
+
+    def _reset(self):
+        self._ts, self._n_det, self._n_box = [], [], []
+        self._ids, self._cls, self._conf, self._xyxy = [], [], [], []
+
+    def append(self, ts: float, n_det: int, xyxy, clss, ids, conf):
+        self._ts.append(ts)
+        self._n_det.append(n_det)
+        self._n_box.append(len(ids))
+        if len(ids):
+            self._ids.append(ids)
+            self._cls.append(clss)
+            self._conf.append(conf)
+            self._xyxy.append(xyxy)
+        if len(self._ts) >= self.max_frames:
+            self.rotate(fresh=False)
+
+    def rotate(self, fresh: bool = True):
+        """Close the current segment. fresh: the tracker starts a new TrainSession from here on."""
+        if self._ts:
+            cols = self._columns()
+            meta = {**self.meta, "fresh_session": self._fresh,
+                    "frames": len(cols["ts"]), "boxes": len(cols["track_id"])}
+            _writer.submit(_write_segment, self.dir, meta, cols)
+            self._reset()
+            self._fresh = fresh
+        elif fresh:
+            self._fresh = True
+
+    def close(self):
+        """Write whatever is buffered and wait for all pending segments."""
+        self.rotate(fresh=False)
+        _writer.submit(lambda: None).result()
+
+    def _columns(self) -> dict:
+        offsets = np.zeros(len(self._ts) + 1, dtype=np.int64)
+        np.cumsum(self._n_box, out=offsets[1:])
+        cat = lambda parts, dtype, shape=(0,): (np.concatenate(parts).astype(dtype) if parts
+                                                else np.empty(shape, dtype))
+        return {
+            "ts": np.asarray(self._ts, dtype=np.float64),
+            "n_det": np.asarray(self._n_det, dtype=np.uint16),
+            "offsets": offsets,
+            "track_id": cat(self._ids, np.int32),
+            "cls": cat(self._cls, np.uint8),
+            "conf": cat(self._conf, np.float16),
+            "xyxy": cat(self._xyxy, np.float32, (0, 4)),
+        }
+
+def _write_segment(root: str, meta: dict, cols: dict):
+    first = float(cols["ts"][0])
+    name = time.strftime("%Y%m%d_%H%M%S", time.gmtime(first)) + f"_{int(first * 1e6) % 1000000:06d}"
+    path = os.path.join(root, name)
+    tmp = path + ".tmp"
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        for k, a in cols.items():
+            np.save(os.path.join(tmp, f"{k}.npy"), a)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({**meta, "first_ts": first, "last_ts": float(cols["ts"][-1])}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        # Journal is a tuning aid; never let it take the tracker down
+        print(f"Journal: could not write {path}: {e}")
+
+# --- replay ---
+
+def load_segment(path: str) -> dict:
+    with open(os.path.join(path, "meta.json")) as f:
+        seg = {"meta": json.load(f)}
+    for k in ("ts", "n_det", "offsets", "track_id", "cls", "conf", "xyxy"):
+        seg[k] = np.load(os.path.join(path, f"{k}.npy"), mmap_mode="r")
+    return seg
+
+def find_chains(root: str) -> list:
+    """Segment paths grouped into chains that replay independently (each starts on a fresh TrainSession)."""
+    chains = []
+    for cam_dir in sorted(os.listdir(root)):
+        cam_path = os.path.join(root, cam_dir)
+        if not os.path.isdir(cam_path):
+            continue
+        for name in sorted(os.listdir(cam_path)):
+            path = os.path.join(cam_path, name)
+            if name.endswith(".tmp") or not os.path.exists(os.path.join(path, "meta.json")):
+                continue
+            with open(os.path.join(path, "meta.json")) as f:
+                fresh = json.load(f).get("fresh_session", True)
+            if fresh or not chains or not chains[-1][0].startswith(cam_path + os.sep):
+                chains.append([])
+            chains[-1].append(path)
+    return chains
+
+def _session_args(meta: dict, overrides: dict) -> dict:
+    """TrainSession kwargs for a chain: the camera's recorded settings, then any non-None override."""
+    pick = lambda k, default: default if overrides.get(k) is None else overrides[k]
+    return {"line_x": pick("line_x", meta["line_x"]),
+            "pixels_per_foot": pick("pixels_per_foot", meta["pixels_per_foot"]),
+            "ltr": pick("ltr", meta["ltr"]), "id_prefix": meta.get("id_prefix", "TP"),
+            "start_frames": overrides.get("START_FRAMES"), "end_timeout": overrides.get("END_TIMEOUT_S"),
+            "min_track_frames": overrides.get("MIN_TRACK_FRAMES")}
+
+def replay_chain(paths: list, overrides: Optional[dict] = None) -> dict:
+    """Run TrainSession over a chain of segments, like count_frame does live."""
+    import tracker
+    overrides = overrides or {}
+    session = args = None
+    trains = []
+    frames = boxes = 0
+    for path in paths:
+        seg = load_segment(path)
+        meta = seg["meta"]
+        x0, x1 = meta.get("frame_x0", 0), meta["frame_x1"]
+        if session is None:
+            args = _session_args(meta, overrides)
+            session = tracker.TrainSession(**args)
+        # Segments are small; one read per column, then views per frame
+        ts, n_det, off = np.asarray(seg["ts"]), np.asarray(seg["n_det"]), np.asarray(seg["offsets"])
+        xyxy = np.asarray(seg["xyxy"], dtype=np.float64)
+        cls, ids = np.asarray(seg["cls"], dtype=np.int64), np.asarray(seg["track_id"], dtype=np.int64)
+        for i in range(len(ts)):
+            now = float(ts[i])
+            a, b = off[i], off[i + 1]
+            session.observe(now, n_det[i] > 0)
+            if b > a:
+                session.update(now, xyxy[a:b], cls[a:b], ids[a:b], x1, x0)
+            if session.maybe_end(now):
+                trains.append({**session.summary(), "camera": meta["camera"]})
+                session = tracker.TrainSession(**args)
+        frames += len(ts)
+        boxes += len(ids)
+    if session is not None and session.active:
+        trains.append({**session.summary(), "camera": meta["camera"]})
+    return {"trains": trains, "frames": frames, "boxes": boxes}
+
+def _epoch_boxes(tid, upd, cls, xyxy, ts_box, line_x, ppf, x0, x1, min_frames, counted_classes):
+    """TrainSession.update's per-box results for one stretch of boxes with no reset in between.
+
+    Tracks are grouped with a stable sort, so each box's previous sighting,
+    age and "already counted" state come from array shifts instead of a
+    per-frame slot lookup. `upd` is each box's TrainSession.update() call
+    number; a gap of more than STALE_TRACK_FRAMES starts the track over, as
+    pruning does live. Returns (crossed, dx, seen, valid_speed, speed) in
+    the original (frame) order.
+    """
+    import tracker
+    n = len(tid)
+    order = np.argsort(tid, kind="stable")
+    t_s, cx_s, ts_s, u_s = tid[order], (xyxy[order, 0] + xyxy[order, 2]) / 2.0, ts_box[order], upd[order]
+    same = np.zeros(n, dtype=bool)
+    same[1:] = (t_s[1:] == t_s[:-1]) & (u_s[1:] - u_s[:-1] <= tracker.STALE_TRACK_FRAMES)
+    prev_cx = np.full(n, np.nan)
+    prev_cx[1:][same[1:]] = cx_s[:-1][same[1:]]
+    prev_ts = np.full(n, np.nan)
+    prev_ts[1:][same[1:]] = ts_s[:-1][same[1:]]
+    group_start = np.maximum.accumulate(np.where(same, 0, np.arange(n)))
+    age = np.arange(n) - group_start + 1
+
+    seen = ~np.isnan(prev_cx)
+    cand = (seen & (age >= min_frames) & np.isin(cls[order], counted_classes)
+            & (((prev_cx < line_x) & (line_x <= cx_s)) | ((prev_cx > line_x) & (line_x >= cx_s))))
+    # Only a track's first crossing counts
+    c = np.cumsum(cand)
+    before_group = np.where(group_start > 0, c[group_start - 1], 0)
+    crossed_s = cand & (c - before_group == 1)
+
+    inv = np.empty(n, dtype=np.int64)
+    inv[order] = np.arange(n)
+    crossed, seen = crossed_s[inv], seen[inv]
+    dx = ((cx_s - prev_cx))[inv]
+    dt = (ts_s - prev_ts)[inv]
+    ok = crossed & (xyxy[:, 0] > x0 + 1) & (xyxy[:, 2] < x1 - 1) & (dt > 0)
+    speed = np.zeros(n)
+    speed[ok] = np.abs(dx[ok]) / ppf / dt[ok] * tracker.MPH_PER_FPS
+    valid = ok & (speed > 0.1) & (speed < tracker.SPEED_MAX_MPH)
+    return crossed, dx, seen, valid, speed
+
+def replay_chain_fast(paths: list, overrides: Optional[dict] = None) -> dict:
+    """Same result as replay_chain, vectorized over whole stretches of boxes.
+
+    Per-track state only resets when a train starts (TrainSession.start) or
+    ends, so the per-box work for each such stretch is done in one batch and
+    only the frame-level start/end state machine runs per frame.
+    """
+    import tracker
+    overrides = overrides or {}
+    segs = [load_segment(p) for p in paths]
+    if not segs:
+        return {"trains": [], "frames": 0, "boxes": 0}
+    meta = segs[0]["meta"]
+    x0, x1 = meta.get("frame_x0", 0), meta["frame_x1"]
+    namer = tracker.TrainSession(**_session_args(meta, overrides))
+    line_x, ppf, ltr = namer.line_x, namer.pixels_per_foot, namer.ltr
+    start_frames, end_timeout, min_frames = namer.start_frames, namer.end_timeout, namer.min_track_frames
+
+    ts = np.concatenate([np.asarray(g["ts"]) for g in segs])
+    n_box = np.concatenate([np.diff(np.asarray(g["offsets"])) for g in segs])
+    offsets = np.zeros(len(ts) + 1, dtype=np.int64)
+    np.cumsum(n_box, out=offsets[1:])
+    tid = np.concatenate([np.asarray(g["track_id"], dtype=np.int64) for g in segs])
+    cls = np.concatenate([np.asarray(g["cls"], dtype=np.int64) for g in segs])
+    xyxy = np.concatenate([np.asarray(g["xyxy"], dtype=np.float64) for g in segs])
+    ts_box = np.repeat(ts, n_box)
+    frame_of = np.repeat(np.arange(len(ts)), n_box)
+    upd = np.repeat(np.cumsum(n_box > 0), n_box)
+    has = (np.concatenate([np.asarray(g["n_det"]) for g in segs]) > 0).tolist()
+    nonempty = (n_box > 0).tolist()
+    ts_l = ts.tolist()
+    names = [tracker.CLASS_MAP.get(int(k)) for k in range(max(tracker.CLASS_MAP) + 1)]
+
+    trains = []
+    n = len(ts_l)
+    e = 0                     # first frame of the current stretch
+    active, run, last_det, train_id = False, 0, 0.0, None
+    observed = False          # frame e's observe() already ran (a start() opened this stretch)
+    while e < n:
+        a = offsets[e]
+        crossed, dx, seen, valid, speed = _epoch_boxes(
+            tid[a:], upd[a:], cls[a:], xyxy[a:], ts_box[a:], line_x, ppf, x0, x1, min_frames, tracker.COUNTED_CLASSES)
+        hit_frames = frame_of[a:][crossed]
+        first_cross = int(hit_frames[0]) if len(hit_frames) else n
+
+        def summary(last_frame):
+            lim = offsets[last_frame + 1] - a
+            cr, k = crossed[:lim], cls[a:a + lim]
+            counts = {c: int(np.count_nonzero(cr & (k == i))) for i, c in enumerate(names) if c}
+            pushes = dx[:lim][seen[:lim]][-tracker.DX_WINDOW:]
+            sp = speed[:lim][valid[:lim]]
+            return {"train_id": train_id,
+                    "direction": tracker.lr_to_compass(float(np.mean(pushes)), ltr) if len(pushes) >= 5 else None,
+                    "locomotive": counts.get("locomotive", 0), "railcar": counts.get("railcar", 0),
+                    "avg_speed_mph": float(sp.mean()) if len(sp) else None,
+                    "median_speed_mph": tracker.hist_median(
+                        np.bincount(tracker.speed_bins(sp), minlength=len(namer.speed_hist)), len(sp)),
+                    "camera": meta["camera"]}
+
+        i, next_e = e, n
+        while i < n:
+            now = ts_l[i]
+            if not observed:
+                run = run + 1 if has[i] else 0
+                if not active and run >= start_frames:
+                    # start(): clears per-track history, so a new stretch begins at this frame
+                    active, run, last_det, train_id = True, 0, now, namer._new_train_id(now)
+                    if i != e:
+                        next_e, observed = i, True
+                        break
+            observed = False
+            if has[i] or nonempty[i]:
+                last_det = now   # observe() (any detection) or update() (tracked boxes)
+                if not active and i == first_cross:
+                    active, train_id = True, namer._new_train_id(now)
+            if active and now - last_det > end_timeout:
+                trains.append(summary(i))
+                active, run, last_det, train_id = False, 0, 0.0, None
+                next_e = i + 1
+                break
+            i += 1
+        else:
+            if active:
+                trains.append(summary(n - 1))
+        e = next_e
+    return {"trains": trains, "frames": n, "boxes": len(tid)}
+
+def replay_journal(root: str, overrides: Optional[dict] = None, workers: int = 0,
+                   exact: bool = False) -> dict:
+    """Replay every chain under root, in parallel across processes when workers > 1.
+
+    exact=True steps a real TrainSession frame by frame (slower; the reference
+    the vectorized replay is checked against).
+    """
+    chains = find_chains(root)
+    fn = replay_chain if exact else replay_chain_fast
+    t0 = time.perf_counter()
+    if workers > 1 and len(chains) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(fn, chains, [overrides] * len(chains)))
+    else:
+        results = [fn(c, overrides) for c in chains]
+    elapsed = time.perf_counter() - t0
+
+    trains = [t for r in results for t in r["trains"]]
+    frames = sum(r["frames"] for r in results)
+    boxes = sum(r["boxes"] for r in results)
+    return {
+        "segments": sum(len(c) for c in chains),
+        "frames": frames,
+        "boxes": boxes,
+        "elapsed_s": round(elapsed, 3),
+        "boxes_per_s": round(boxes / elapsed) if elapsed > 0 else 0,
+        "trains": trains,
+        "totals": {
+            "locomotive": sum(t["locomotive"] for t in trains),
+            "railcar": sum(t["railcar"] for t in trains),
+        },
+    }
+
+def diff_trains(ref: list, got: list, speed_tol: float = 0.01) -> list:
+    """Human-readable differences between two replays' train lists (empty if they agree)."""
+    import tracker
+    out = []
+    if len(ref) != len(got):
+        out.append(f"{len(ref)} trains vs {len(got)}")
+    for a, b in zip(ref, got):
+        for k in ("train_id", "camera", "direction", "locomotive", "railcar"):
+            if a[k] != b[k]:
+                out.append(f"{a['train_id']}: {k} {a[k]} vs {b[k]}")
+        # float32 vs float64 speeds may land one histogram bin apart
+        for k, tol in (("avg_speed_mph", speed_tol), ("median_speed_mph", tracker.SPEED_BIN_MPH + 1e-6)):
+            if (a[k] is None) != (b[k] is None) or (a[k] is not None and abs(a[k] - b[k]) > tol):
+                out.append(f"{a['train_id']}: {k} {a[k]} vs {b[k]}")
+    return out
+
+def check_parity(root: str, overrides: Optional[dict] = None, workers: int = 0) -> list:
+    """Replay root both ways; differences between the fast path and the exact reference."""
+    exact = replay_journal(root, overrides, workers, exact=True)
+    fast = replay_journal(root, overrides, workers)
+    print(f"exact {exact['elapsed_s']}s, fast {fast['elapsed_s']}s over {fast['boxes']} boxes, "
+          f"{len(exact['trains'])} trains")
+    return diff_trains(exact["trains"], fast["trains"])
+
+def main():
+    ap = argparse.ArgumentParser(description="Re-run the counting logic over a detection journal.")
+    ap.add_argument("root", nargs="?", default=JOURNAL_DIR or "journal")
+    ap.add_argument("--line-x", type=float)
+    ap.add_argument("--pixels-per-foot", type=float)
+    ap.add_argument("--ltr", choices=["EB", "WB", "NB", "SB"])
+    ap.add_argument("--start-frames", type=int)
+    ap.add_argument("--end-timeout", type=float)
+    ap.add_argument("--min-track-frames", type=int)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--exact", action="store_true", help="step a real TrainSession per frame (slow reference)")
+    ap.add_argument("--check", action="store_true", help="replay both ways and fail if fast differs from --exact")
+    ap.add_argument("--json", action="store_true", help="print the raw result as JSON")
+    args = ap.parse_args()
+
+    overrides = {"line_x": args.line_x, "pixels_per_foot": args.pixels_per_foot, "ltr": args.ltr,
+                 "START_FRAMES": args.start_frames, "END_TIMEOUT_S": args.end_timeout,
+                 "MIN_TRACK_FRAMES": args.min_track_frames}
+    if args.check:
+        diffs = check_parity(args.root, overrides, args.workers)
+        for d in diffs:
+            print(f"  {d}")
+        print("fast replay matches exact" if not diffs else f"{len(diffs)} differences")
+        raise SystemExit(1 if diffs else 0)
+    res = replay_journal(args.root, overrides, args.workers, args.exact)
+    if args.json:
+        print(json.dumps(res, indent=2))
+        return
+    print(f"{res['segments']} segments, {res['frames']} frames, {res['boxes']} boxes "
+          f"in {res['elapsed_s']}s ({res['boxes_per_s']} boxes/s)")
+    for t in res["trains"]:
+        print(f"  {t['train_id']} {t['direction'] or '--'}: "
+              f"{t['locomotive']} locomotives, {t['railcar']} railcars")
+    print(f"  totals: {res['totals']['locomotive']} locomotives, {res['totals']['railcar']} railcars")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""Synthetic load test for the web tier: seeded history, a burst of tracker events, many clients.
+
+    python loadtest.py seed --years 3              # synthetic history in loadtest.db (refuses a non-empty DB)
+    python loadtest.py run --ws 200 --pollers 20 --out lt.json
+    python loadtest.py run --ws 200 --pollers 20 --baseline lt.json
+
+`run` starts app.py in a child process, on a scratch copy of the seeded DB,
+with the camera/model/OCR loops (and compaction) replaced by a synthetic
+tracker. Once the /ws clients are connected it
+injects a burst (--trains trains of --cars cars on each of --cameras cameras)
+through the real event_queue and PersistenceWriter, while REST pollers hit
+the dashboard endpoints. Reported: event delivery latency (count events carry
+the server's send time), delivery ratio and dropped clients, request latency
+per endpoint, and the server's CPU and peak RSS. Fixed --seed and rates make
+runs comparable; this process's own CPU is shown too, since one client
+process can saturate before the server does.
+
+Needs httpx and websockets (both in requirements.txt).
+"""
+import argparse, asyncio, json, os, random, socket, sqlite3, subprocess, sys, tempfile, time
+from datetime import date, datetime, timedelta, timezone
+
+# CONFIG
+DEFAULT_DB = "loadtest.db"     # never the real train_counter.db
+SEED_CHUNK_DAYS = 30           # days of synthetic history inserted per transaction
+CAR_LENGTH_FT = 60
+POLL_ENDPOINTS = [
+    "/api/summary/daily",
+    "/api/trains/recent",
+    "/api/summary/hourly?days=2",
+    "/api/trains?limit=50&events=true",
+    "/api/engines/by_direction",
+]
+READY_TIMEOUT_S = 120
+CONNECT_TIMEOUT_S = 30         # the burst starts when all clients are in, or after this long
+DONE_EVENT = "loadtest_done"
+
+def _use_db(path: str):
+    # db.py reads DB_URL at import, so this has to run before anything imports it
+    os.environ["DB_URL"] = path if "://" in path else f"sqlite:///{path}"
+
+# --- seeding ---
+
+def _synthetic_day(rng: random.Random, day: date, trains_per_day: int, used_ids: set):
+    """(train_pass row, car rows, sighting rows) for every train of one day."""
+    n = rng.randint(int(trains_per_day * 0.7), int(trains_per_day * 1.3))
+    for _ in range(n):
+        start = datetime.combine(day, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))
+        train_id = f"LT_{start:%Y%m%d_%H%M%S}"
+        while train_id in used_ids:
+            start += timedelta(seconds=1)
+            train_id = f"LT_{start:%Y%m%d_%H%M%S}"
+        used_ids.add(train_id)
+        direction = rng.choice(("EB", "WB"))
+        locos, railcars = rng.randint(1, 4), rng.choice((rng.randint(5, 40), rng.randint(60, 150)))
+        speed = rng.uniform(10, 50)
+        per_car = timedelta(seconds=CAR_LENGTH_FT / (speed * 5280 / 3600))
+        cars = [("locomotive" if i < locos else "railcar", start + per_car * (i + 1))
+                for i in range(locos + railcars)]
+        tp = {"train_id": train_id, "start_ts": start, "end_ts": cars[-1][1] + timedelta(seconds=10),
+              "direction": direction, "total_locomotives": locos, "total_railcars": railcars,
+              "avg_speed_mph": round(speed, 1), "camera": "main", "extra": {}}
+        sightings = [(i, f"{rng.randint(1000, 9999)}", ts) for i, (k, ts) in enumerate(cars)
+                     if k == "locomotive" and rng.random() < 0.7]
+        yield tp, [(i, k, direction, ts) for i, (k, ts) in enumerate(cars)], sightings
+
+def seed(years: float, trains_per_day: int, seed_value: int, end: date, append: bool):
+    from sqlalchemy import func, insert
+    import rollup
+    from db import SessionLocal, init_db, TrainPass, CarEvent, EngineSighting
+    init_db()
+    db = SessionLocal()
+    try:
+        if db.query(TrainPass.id).first() is not None and not append:
+            sys.exit("Database already has trains; use --append to add synthetic history anyway")
+        rng = random.Random(seed_value)
+        next_id = (db.query(func.max(TrainPass.id)).scalar() or 0) + 1
+        used_ids = {t for (t,) in db.query(TrainPass.train_id).filter(TrainPass.train_id.like("LT_%"))}
+        day, n_days = end - timedelta(days=int(years * 365)), int(years * 365) + 1
+        t0, n_trains, n_cars = time.perf_counter(), 0, 0
+        for chunk_start in range(0, n_days, SEED_CHUNK_DAYS):
+            passes, cars, sightings = [], [], []
+            for d in range(chunk_start, min(n_days, chunk_start + SEED_CHUNK_DAYS)):
+                for tp, tcars, tsight in _synthetic_day(rng, day + timedelta(days=d), trains_per_day, used_ids):
+                    passes.append({"id": next_id, **tp})
+                    cars += [{"train_pass_id": next_id, "track_id": i, "klass": k, "direction": dd,
+                              "crossed_ts": ts} for i, k, dd, ts in tcars]
+                    sightings += [{"train_pass_id": next_id, "track_id": i, "engine_number": num,
+                                   "first_seen_ts": ts} for i, num, ts in tsight]
+                    next_id += 1
+            db.execute(insert(TrainPass), passes)
+            db.execute(insert(CarEvent), cars)
+            if sightings:
+                db.execute(insert(EngineSighting), sightings)
+            db.commit()
+            n_trains, n_cars = n_trains + len(passes), n_cars + len(cars)
+        buckets = rollup.rebuild(db)
+        print(f"Seeded {n_trains} trains / {n_cars} car events from {day} to {end} "
+              f"in {time.perf_counter() - t0:.1f}s; rollup rebuilt ({buckets} buckets)")
+    finally:
+        db.close()
+
+# --- server side (child process) ---
+
+async def _inject_burst(writer, event_queue, cameras: int, trains: int, cars: int, car_rate: float,
+                        seed_value: int):
+    """Tracker-shaped events for `trains` back-to-back trains on each camera, cameras in parallel."""
+    async def camera(cam: str, rng: random.Random):
+        for t in range(trains):
+            train_id = f"LT_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}_{cam}_{t}"
+            direction, locos = rng.choice(("EB", "WB")), rng.randint(2, 4)
+            now = time.time()
+            writer.train_start(train_id, now, camera=cam)
+            await event_queue.put({"event": "train_start", "train_id": train_id, "camera": cam, "ts": now})
+            totals, speeds = {}, []
+            for i in range(cars):
+                klass = "locomotive" if i < locos else "railcar"
+                totals[klass] = totals.get(klass, 0) + 1
+                speeds.append(rng.uniform(20, 40))
+                writer.car_event(train_id, i, klass, direction, time.time())
+                await event_queue.put({
+                    "event": "count", "train_id": train_id, "camera": cam, "track_id": i,
+                    "class": klass, "direction": direction, "speed_mph": round(speeds[-1], 1),
+                    "avg_speed_mph": round(sum(speeds) / len(speeds), 1), "totals": dict(totals),
+                    "ts": time.time()})
+                if klass == "locomotive":
+                    await event_queue.put({"event": "engine_number", "train_id": train_id,
+                                           "track_id": i, "engine_number": f"{rng.randint(1000, 9999)}"})
+                await asyncio.sleep(1.0 / car_rate)
+            summary = {"train_id": train_id, "direction": direction, "locomotive": totals.get("locomotive", 0),
+                       "railcar": totals.get("railcar", 0), "avg_speed_mph": sum(speeds) / len(speeds)}
+            writer.train_end(train_id, summary)
+            await event_queue.put({"event": "train_end", "train_id": train_id, "camera": cam,
+                                   "ts": time.time(), "direction": direction,
+                                   "final_totals": {"locomotive": summary["locomotive"],
+                                                    "railcar": summary["railcar"]}})
+
+    await asyncio.gather(*(camera(f"cam{c}", random.Random(seed_value * 100 + c)) for c in range(cameras)))
+
+def serve(args):
+    import uvicorn
+    import app
+    import startup
+    from persistence import PersistenceWriter
+
+    async def synthetic_tracker(on_commit=None, db_ready=None):
+        await db_ready
+        writer = PersistenceWriter(on_commit=on_commit).start()
+        startup.ready("tracker")
+        try:
+            deadline = time.monotonic() + CONNECT_TIMEOUT_S
+            while len(app.event_queue.subscribers) < args.ws and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(1.0)   # let pollers get going too
+            await _inject_burst(writer, app.event_queue, args.cameras, args.trains, args.cars,
+                                args.car_rate, args.seed)
+            await app.event_queue.put({"event": DONE_EVENT})
+            await asyncio.Event().wait()
+        finally:
+            await asyncio.to_thread(writer.close)
+
+    async def no_ocr(ocr_queue, event_queue):
+        startup.ready("ocr")
+        await asyncio.Event().wait()
+
+    async def no_compaction():
+        pass
+
+    # lifespan looks these up at startup
+    app.tracker_loop, app.ocr_loop, app.compaction_loop = synthetic_tracker, no_ocr, no_compaction
+    uvicorn.run(app.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+# --- client side ---
+
+def proc_usage(pid: int):
+    """(cpu seconds, rss bytes) of a process, from /proc (or psutil elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        return ((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"),
+                rss_pages * os.sysconf("SC_PAGE_SIZE"))
+    except FileNotFoundError:
+        import psutil
+        p = psutil.Process(pid)
+        t = p.cpu_times()
+        return t.user + t.system, p.memory_info().rss
+
+async def _wait_ready(base: str, proc):
+    import httpx
+    deadline = time.monotonic() + READY_TIMEOUT_S
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                sys.exit(f"Server exited with code {proc.returncode}")
+            try:
+                if (await client.get(base + "/readyz")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    sys.exit("Server did not become ready")
+
+async def _ws_client(url: str, connected: asyncio.Event, out: dict):
+    import websockets
+    from websockets.exceptions import ConnectionClosed
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=CONNECT_TIMEOUT_S) as ws:
+            out["connected"] += 1
+            if out["connected"] >= out["clients"]:
+                connected.set()
+            async for raw in ws:
+                now = time.time()
+                ev = json.loads(raw)
+                if ev.get("event") == "count":
+                    out["latency"].append(now - ev["ts"])
+                elif ev.get("event") == DONE_EVENT:
+                    break
+    except ConnectionClosed as e:
+        out["dropped" if e.rcvd and e.rcvd.code == 1013 else "errors"] += 1
+    except (OSError, asyncio.TimeoutError):
+        out["errors"] += 1
+
+async def _poller(base: str, interval: float, stop: asyncio.Event, i: int, out: dict):
+    import httpx
+    async with httpx.AsyncClient(base_url=base, timeout=30) as client:
+        k = i   # stagger which endpoint each poller starts on
+        while not stop.is_set():
+            path = POLL_ENDPOINTS[k % len(POLL_ENDPOINTS)]
+            k += 1
+            t0 = time.perf_counter()
+            try:
+                r = await client.get(path)
+                ok = r.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            out.setdefault(path, {"latency": [], "errors": 0})
+            out[path]["latency"].append(time.perf_counter() - t0)
+            out[path]["errors"] += not ok
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+async def _sample(pid: int, stop: asyncio.Event, out: dict):
+    out["peak_rss"] = proc_usage(pid)[1]
+    while not stop.is_set():
+        try:
+            out["peak_rss"] = max(out["peak_rss"], proc_usage(pid)[1])
+        except (FileNotFoundError, ProcessLookupError):
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+async def drive(args, base: str, proc) -> dict:
+    from replay import percentiles
+    await _wait_ready(base, proc)
+    ws_out = {"clients": args.ws, "connected": 0, "dropped": 0, "errors": 0, "latency": []}
+    http_out, sample_out = {}, {}
+    connected, stop = asyncio.Event(), asyncio.Event()
+    if not args.ws:
+        connected.set()
+
+    ws_url = base.replace("http://", "ws://") + "/ws"
+    clients = [asyncio.create_task(_ws_client(ws_url, connected, ws_out)) for _ in range(args.ws)]
+    try:
+        await asyncio.wait_for(connected.wait(), CONNECT_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        print(f"Only {ws_out['connected']}/{args.ws} clients connected; running anyway")
+
+    cpu0, wall0, own0 = proc_usage(proc.pid)[0], time.perf_counter(), time.process_time()
+    helpers = [asyncio.create_task(_poller(base, args.poll_interval, stop, i, http_out))
+               for i in range(args.pollers)]
+    helpers.append(asyncio.create_task(_sample(proc.pid, stop, sample_out)))
+    burst_s = args.trains * args.cars / args.car_rate
+    if clients:
+        await asyncio.wait(clients, timeout=burst_s + 60)
+    else:
+        await asyncio.sleep(burst_s + 1.0)
+    stop.set()
+    await asyncio.gather(*helpers)
+    for t in clients:
+        t.cancel()
+    wall = time.perf_counter() - wall0
+    cpu = proc_usage(proc.pid)[0] - cpu0
+
+    expected = args.cameras * args.trains * args.cars * ws_out["connected"]
+    return {
+        "config": {k: getattr(args, k) for k in ("ws", "pollers", "poll_interval", "cameras", "trains",
+                                                  "cars", "car_rate", "seed")},
+        "ws": {"connected": ws_out["connected"], "dropped": ws_out["dropped"], "errors": ws_out["errors"],
+               "count_events": len(ws_out["latency"]),
+               "delivered": round(len(ws_out["latency"]) / expected, 4) if expected else None,
+               "latency_ms": percentiles(ws_out["latency"])},
+        "http": {p: {"requests": len(v["latency"]), "errors": v["errors"],
+                     "latency_ms": percentiles(v["latency"])} for p, v in sorted(http_out.items())},
+        "server": {"cpu_percent": round(100 * cpu / wall, 1), "peak_rss_mb": round(sample_out["peak_rss"] / 2**20, 1)},
+        "client_cpu_percent": round(100 * (time.process_time() - own0) / wall, 1),
+        "duration_s": round(wall, 1),
+    }
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _sqlite_path(db: str) -> str:
+    if "://" not in db:
+        return db
+    if db.startswith("sqlite:///"):
+        return db[len("sqlite:///"):]
+    sys.exit("run needs a SQLite database: every run works on a scratch copy of it")
+
+def run(args) -> dict:
+    """Serve a scratch copy of the seeded DB, so the burst's writes never change the next run's data."""
+    src = _sqlite_path(args.db)
+    if not os.path.exists(src):
+        sys.exit(f"{src} not found; create it with: python loadtest.py seed --db {src}")
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as tmp:
+        scratch = os.path.join(tmp, "loadtest.db")
+        with sqlite3.connect(src) as a, sqlite3.connect(scratch) as b:
+            a.backup(b)   # consistent copy, including anything still in the WAL
+        port = args.port or _free_port()
+        cmd = [sys.executable, os.path.abspath(__file__), "serve", "--db", scratch, "--port", str(port),
+               "--ws", str(args.ws), "--cameras", str(args.cameras), "--trains", str(args.trains),
+               "--cars", str(args.cars), "--car-rate", str(args.car_rate), "--seed", str(args.seed)]
+        proc = subprocess.Popen(cmd)
+        try:
+            return asyncio.run(drive(args, f"http://127.0.0.1:{port}", proc))
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+def print_report(res: dict):
+    ws, srv = res["ws"], res["server"]
+    lat = ws["latency_ms"]
+    print(f"/ws: {ws['connected']} clients, {ws['count_events']} count events received "
+          f"(delivered {ws['delivered']}), {ws['dropped']} dropped, {ws['errors']} errors")
+    print(f"     latency ms p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    print(f"{'endpoint':<36} {'reqs':>6} {'err':>4} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for path, h in res["http"].items():
+        l = h["latency_ms"]
+        print(f"{path:<36} {h['requests']:>6} {h['errors']:>4} {l['p50']!s:>8} {l['p90']!s:>8} "
+              f"{l['p99']!s:>8} {l['max']!s:>8}")
+    print(f"server: {srv['cpu_percent']}% CPU, peak RSS {srv['peak_rss_mb']} MB over {res['duration_s']}s "
+          f"(load generator: {res['client_cpu_percent']}% CPU)")
+    if res["client_cpu_percent"] > 90:
+        print("warning: the load generator was CPU-bound; latencies include client-side queueing")
+
+def compare_baseline(res: dict, base: dict, tolerance: float) -> list:
+    """(metric, old, new) for p99 latencies and server CPU that got worse than the tolerance allows."""
+    pairs = [("ws p99", base["ws"]["latency_ms"]["p99"], res["ws"]["latency_ms"]["p99"]),
+             ("server cpu%", base["server"]["cpu_percent"], res["server"]["cpu_percent"])]
+    pairs += [(f"{p} p99", base["http"][p]["latency_ms"]["p99"], h["latency_ms"]["p99"])
+              for p, h in res["http"].items() if p in base["http"]]
+    return [(m, old, new) for m, old, new in pairs
+            if old is not None and new is not None and new > old * (1.0 + tolerance)]
+
+def main():
+    ap = argparse.ArgumentParser(description="Synthetic load test for the web tier.")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    sp = sub.add_parser("seed", help="fill a database with synthetic train history")
+    sp.add_argument("--db", default=DEFAULT_DB, help="SQLite file or SQLAlchemy URL")
+    sp.add_argument("--years", type=float, default=3.0)
+    sp.add_argument("--trains-per-day", type=int, default=30)
+    sp.add_argument("--end", type=date.fromisoformat, default=date.today(), help="last seeded day")
+    sp.add_argument("--seed", type=int, default=1)
+    sp.add_argument("--append", action="store_true", help="seed even if the database already has trains")
+
+    for name in ("run", "serve"):
+        rp = sub.add_parser(name, help="drive a local server with clients" if name == "run" else argparse.SUPPRESS)
+        rp.add_argument("--db", default=DEFAULT_DB, help="SQLite file or SQLAlchemy URL")
+        rp.add_argument("--port", type=int, default=0, help="default: any free port")
+        rp.add_argument("--ws", type=int, default=100, help="concurrent /ws clients")
+        rp.add_argument("--cameras", type=int, default=1, help="trains passing at the same time")
+        rp.add_argument("--trains", type=int, default=2, help="trains per camera in the burst")
+        rp.add_argument("--cars", type=int, default=150, help="cars per train")
+        rp.add_argument("--car-rate", type=float, default=5.0, help="cars counted per second per camera")
+        rp.add_argument("--seed", type=int, default=1)
+        if name == "run":
+            rp.add_argument("--pollers", type=int, default=10, help="concurrent REST pollers")
+            rp.add_argument("--poll-interval", type=float, default=1.0, help="seconds between a poller's requests")
+            rp.add_argument("--out", help="write results as JSON")
+            rp.add_argument("--baseline", help="previous --out file to compare against")
+            rp.add_argument("--tolerance", type=float, default=0.20, help="allowed fractional p99/CPU increase")
+    args = ap.parse_args()
+    _use_db(args.db)
+
+    if args.command == "seed":
+        seed(args.years, args.trains_per_day, args.seed, args.end, args.append)
+        return
+    if args.command == "serve":
+        serve(args)
+        return
+
+    res = run(args)
+    print_report(res)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        if base["config"] != res["config"]:
+            print(f"warning: baseline was run with a different config: {base['config']}")
+        worse = compare_baseline(res, base, args.tolerance)
+        for metric, old, new in worse:
+            print(f"regression: {metric} {old} -> {new}")
+        sys.exit(1 if worse else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Low-overhead in-process metrics, rendered in the Prometheus text format for /metrics.
+
+Hot paths only pay for a perf_counter() pair and one Histogram.observe()
+(a bisect and three additions under an uncontended lock). Gauges are
+callbacks evaluated at scrape time, so queue depths, fps and drop counters
+cost nothing between scrapes.
+"""
+import bisect, threading
+
+# CONFIG
+PREFIX = "trainspotting"
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY = []
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """Fixed-bucket histogram with one label (e.g. stage); series are created on first use."""
+    def __init__(self, name: str, help: str, label: str, buckets: tuple = STAGE_BUCKETS):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}   # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, label_value: str, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(label_value)
+            if s is None:
+                s = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for lv, s in sorted(series.items()):
+            cum = 0
+            for le, n in zip(self.buckets + (float("inf"),), s):
+                cum += n
+                le_s = "+Inf" if le == float("inf") else repr(le)
+                extra = f'le="{le_s}"'
+                lines.append(f"{self.name}_bucket{_labels((self.label,), (lv,), extra)} {cum}")
+            lines.append(f"{self.name}_sum{_labels((self.label,), (lv,))} {s[-2]:.6f}")
+            lines.append(f"{self.name}_count{_labels((self.label,), (lv,))} {s[-1]}")
+        return lines
+
+class Gauge:
+    """Value read at scrape time. fn returns a number, or {label value(s): number} for labelled series."""
+    def __init__(self, name: str, help: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name = f"{PREFIX}_{name}"
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+        self.kind = kind   # "gauge" or "counter"
+        REGISTRY.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            # A broken callback must not take the whole scrape down
+            return lines + [f"# error: {e}"]
+        if isinstance(value, dict):
+            for lv, v in sorted(value.items()):
+                lv = lv if isinstance(lv, tuple) else (lv,)
+                lines.append(f"{self.name}{_labels(self.labels, lv)} {float(v or 0)}")
+        elif value is not None:
+            lines.append(f"{self.name} {float(value)}")
+        return lines
+
+stage_seconds = Histogram("stage_seconds", "Time spent per pipeline stage, per frame / batch / crop.", "stage")
+
+def render() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
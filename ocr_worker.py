@@ -1,13 +1,36 @@
-import asyncio, os, re
-from collections import defaultdict, Counter
-from db import SessionLocal, TrainPass, EngineSighting
+import abc, asyncio, glob, os, re, threading, time
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from db import run_db, TrainPass, EngineSighting
+from metrics import Gauge, stage_seconds
+import startup
 from datetime import datetime, timezone
+from typing import Optional
 
 # If needed on Windows:
 # pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
 DIGIT_RE = re.compile(r"\b(\d{4})\b")
 
+# CONFIG
+OCR_BACKEND = os.environ.get("OCR_BACKEND", "auto")   # "auto", "tesserocr", "templates" or "pytesseract"
+DIGIT_TEMPLATE_DIR = "ocr_digits"   # <digit>_<n>.png glyph samples for the "templates" backend
+TESSERACT_CONFIG = r"--psm 7 -c tessedit_char_whitelist=0123456789"
+OCR_CONSENSUS = 2              # matching reads needed before a track's number is final
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", max(1, (os.cpu_count() or 2) // 2)))  # 0 = single in-process thread
+OCR_BATCH_SIZE = 4             # crops sent to a worker per dispatch
+OCR_QUEUE_SIZE = 64            # crops waiting for OCR before low-ranked ones are dropped
+OCR_CACHE_TTL_S = 1800.0       # forget a train's OCR state this long after its last activity
+OCR_CACHE_MAX_TRACKS = 500     # hard cap on locomotive tracks held in memory (oldest trains evicted)
+
+# Pool status, for logs / metrics
+ocr_stats = {"workers": 0, "backend": None, "inflight_batches": 0, "batches": 0, "crops": 0}
+
+Gauge("ocr_workers", "OCR worker processes.", lambda: ocr_stats["workers"])
+Gauge("ocr_inflight_batches", "OCR batches dispatched and not yet read back.", lambda: ocr_stats["inflight_batches"])
+Gauge("ocr_batches_total", "OCR batches completed.", lambda: ocr_stats["batches"], kind="counter")
+Gauge("ocr_crops_total", "Crops read by OCR.", lambda: ocr_stats["crops"], kind="counter")
+
 def preprocess(img):
     # Grayscale, enlarge, denoise, binarize → better OCR on side numbers
     import cv2
@@ -17,58 +40,436 @@ def preprocess(img):
     _, bw = cv2.threshold(g, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     return bw
 
-async def ocr_loop(ocr_queue, event_queue):
-    """Consumes locomotive crops, extracts 4-digit number, stores best guess per track."""
-    # Allow server to start
-    await asyncio.sleep(1.0)
-    
-    # Verify tesseract is effectively "loaded" (it's a subprocess, but checking availability helps)
-    # We can assume it's ready if we can import it.
-    import pytesseract
-    print("Tesseract loaded completely") # User requested this output
+class OCRBackend(abc.ABC):
+    """Turns a preprocessed (binarized) crop into text. Loaded once, reused for every crop."""
+    name = "base"
+
+    @abc.abstractmethod
+    def recognize(self, bw) -> str:
+        ...
+
+class TesserocrBackend(OCRBackend):
+    """Long-lived in-process Tesseract API handle (tesserocr): language data is loaded once."""
+    name = "tesserocr"
+
+    def __init__(self):
+        import tesserocr
+        self.api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_LINE)
+        self.api.SetVariable("tessedit_char_whitelist", "0123456789")
+        self._lock = threading.Lock()   # the API handle is not thread-safe
+
+    def recognize(self, bw) -> str:
+        from PIL import Image
+        with self._lock:
+            self.api.SetImage(Image.fromarray(bw))
+            return self.api.GetUTF8Text()
+
+class DigitTemplateBackend(OCRBackend):
+    """Small OpenCV/NumPy digit classifier: connected components matched against glyph templates."""
+    name = "templates"
+    GLYPH_SIZE = (20, 32)   # w, h every glyph is normalized to
+    MIN_SCORE = 0.5         # minimum normalized correlation to accept a glyph
+
+    def __init__(self, template_dir: str = DIGIT_TEMPLATE_DIR):
+        import cv2
+        temps, labels = [], []
+        for d in "0123456789":
+            for path in sorted(glob.glob(os.path.join(template_dir, f"{d}_*.png"))):
+                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                if img is not None:
+                    temps.append(self._normalize(self._ink(img)))
+                    labels.append(d)
+        if not temps:
+            raise FileNotFoundError(f"No digit templates in {template_dir}")
+        import numpy as np
+        self.templates = np.stack(temps)
+        self.labels = labels
+
+    @staticmethod
+    def _ink(bw):
+        # Make digits white on black; the border is mostly background
+        border = [bw[0, :], bw[-1, :], bw[:, 0], bw[:, -1]]
+        light = sum(int((b > 127).sum()) for b in border) > sum(len(b) for b in border) / 2
+        return 255 - bw if light else bw
+
+    def _normalize(self, glyph):
+        import cv2
+        g = cv2.resize(glyph, self.GLYPH_SIZE, interpolation=cv2.INTER_AREA).astype("float32").ravel()
+        g -= g.mean()
+        n = float((g * g).sum()) ** 0.5
+        return g / n if n else g
+
+    def recognize(self, bw) -> str:
+        import cv2, numpy as np
+        ink = self._ink(bw)
+        n, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+        h = bw.shape[0]
+        # Digit-shaped blobs: taller than wide, a decent share of the crop height
+        comps = [stats[i] for i in range(1, n)
+                 if 0.2 * h <= stats[i][3] <= 0.95 * h and stats[i][2] < stats[i][3]]
+        if not comps:
+            return ""
+        med_h = float(np.median([c[3] for c in comps]))
+        comps = sorted((c for c in comps if abs(c[3] - med_h) <= 0.3 * med_h), key=lambda c: c[0])
+
+        glyphs = np.stack([self._normalize(ink[y:y + gh, x:x + gw]) for x, y, gw, gh, _ in comps])
+        scores = glyphs @ self.templates.T
+        best = scores.argmax(axis=1)
+
+        # Rebuild text, splitting digit groups on wide gaps so DIGIT_RE still sees word boundaries
+        out, prev_right = [], None
+        for (x, y, gw, gh, _), b, sc in zip(comps, best, scores[np.arange(len(best)), best]):
+            if sc < self.MIN_SCORE:
+                continue
+            if prev_right is not None and x - prev_right > 0.35 * med_h:
+                out.append(" ")
+            out.append(self.labels[b])
+            prev_right = x + gw
+        return "".join(out)
+
+class PytesseractBackend(OCRBackend):
+    """Fallback: forks a tesseract process per crop."""
+    name = "pytesseract"
+
+    def __init__(self):
+        import pytesseract
+        self._pt = pytesseract
+
+    def recognize(self, bw) -> str:
+        return self._pt.image_to_string(bw, config=TESSERACT_CONFIG)
+
+BACKENDS = {
+    "tesserocr": TesserocrBackend,
+    "templates": DigitTemplateBackend,
+    "pytesseract": PytesseractBackend,
+}
+
+def load_backend(name: str = OCR_BACKEND) -> OCRBackend:
+    """Load the configured backend; "auto" tries the in-process engines first and falls back to pytesseract."""
+    order = list(BACKENDS) if name == "auto" else [name, "pytesseract"]
+    for key in order:
+        try:
+            backend = BACKENDS[key]()
+            print(f"OCR backend: {backend.name}")
+            return backend
+        except (ImportError, OSError, RuntimeError) as e:
+            print(f"OCR backend {key} unavailable: {e}")
+    raise RuntimeError("No OCR backend available")
+
+def ocr_crop(backend: OCRBackend, img):
+    """Preprocess + recognize one crop; returns (text, preprocess_s, recognize_s)."""
+    t0 = time.perf_counter()
+    bw = preprocess(img)
+    t1 = time.perf_counter()
+    text = backend.recognize(bw)
+    return text, t1 - t0, time.perf_counter() - t1
+
+class _TrainOCRState:
+    __slots__ = ("votes", "settled", "pass_id", "persisted", "pending", "ended", "touched")
+
+    def __init__(self):
+        self.votes = {}          # track_id -> Counter of candidate numbers
+        self.settled = set()     # track_ids whose number has been decided
+        self.pass_id = None      # TrainPass.id, looked up once
+        self.persisted = set()   # (track_id, engine_number) already written to engine_sighting
+        self.pending = 0         # crops queued or in flight for this train
+        self.ended = False
+        self.touched = time.monotonic()
+
+class CandidateStore:
+    """OCR votes, settled tracks and the persisted-sighting index, grouped per train.
+
+    A train's entries are evicted once the tracker reports train_end and its
+    last queued crop has been processed, after OCR_CACHE_TTL_S without
+    activity, or (oldest train first) when more than OCR_CACHE_MAX_TRACKS
+    tracks are held.
+    """
+    def __init__(self, ttl: float = OCR_CACHE_TTL_S, max_tracks: int = OCR_CACHE_MAX_TRACKS):
+        self.ttl = ttl
+        self.max_tracks = max_tracks
+        self.evicted = 0
+        self._trains = OrderedDict()   # train_id -> _TrainOCRState, least recently used first
+
+    def __len__(self) -> int:
+        return sum(len(t.votes) + len(t.settled - t.votes.keys()) for t in self._trains.values())
+
+    def _get(self, train_id: str, create: bool = True) -> "_TrainOCRState":
+        st = self._trains.get(train_id)
+        if st is None and create:
+            st = self._trains[train_id] = _TrainOCRState()
+        if st is not None:
+            st.touched = time.monotonic()
+            self._trains.move_to_end(train_id)
+        return st
+
+    def _evict(self, train_id: str):
+        if self._trains.pop(train_id, None) is not None:
+            self.evicted += 1
+
+    def add_votes(self, train_id: str, track_id: int, cands: list) -> Counter:
+        st = self._get(train_id)
+        votes = st.votes.setdefault(track_id, Counter())
+        votes.update(cands)
+        # Hard memory cap: drop whole trains, oldest first, but never the one being voted on
+        while len(self) > self.max_tracks and next(iter(self._trains)) != train_id:
+            self._evict(next(iter(self._trains)))
+        return votes
+
+    def is_settled(self, train_id: str, track_id: int) -> bool:
+        st = self._trains.get(train_id)
+        return st is not None and track_id in st.settled
+
+    def settle(self, train_id: str, track_id: int):
+        st = self._get(train_id)
+        st.settled.add(track_id)
+        st.votes.pop(track_id, None)   # votes are no longer needed once decided
 
-    cache = defaultdict(list)  # (train_id, track_id) -> [candidates]
+    def enqueued(self, train_id: str):
+        self._get(train_id).pending += 1
 
+    def done(self, train_id: str):
+        st = self._trains.get(train_id)
+        if st is None:
+            return
+        st.pending = max(0, st.pending - 1)
+        if st.ended and st.pending == 0:
+            self._evict(train_id)
+
+    def end_train(self, train_id: str):
+        st = self._trains.get(train_id)
+        if st is None:
+            return
+        st.ended = True
+        if st.pending == 0:
+            self._evict(train_id)
+
+    def expire(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        while self._trains:
+            train_id, st = next(iter(self._trains.items()))
+            if now - st.touched <= self.ttl:
+                break
+            self._evict(train_id)
+
+    def pass_id(self, train_id: str) -> Optional[int]:
+        st = self._trains.get(train_id)
+        return st.pass_id if st else None
+
+    def set_pass_id(self, train_id: str, pass_id: int):
+        self._get(train_id).pass_id = pass_id
+
+    def is_persisted(self, train_id: str, track_id: int, number: str) -> bool:
+        st = self._trains.get(train_id)
+        return st is not None and (track_id, number) in st.persisted
+
+    def mark_persisted(self, train_id: str, track_id: int, number: str):
+        self._get(train_id).persisted.add((track_id, number))
+
+class CropQueue:
+    """Bounded queue of OCR crops between the tracker and the OCR pool.
+
+    put_nowait() never blocks the tracker: crops of tracks that already reached
+    consensus are dropped, and when full the lowest-ranked (worst) crop goes
+    first. get_batch() hands out up to n crops in arrival order. Per-train OCR
+    state lives in `store`; every accepted crop must eventually be reported
+    back through store.done().
+    """
+    def __init__(self, maxsize: int = OCR_QUEUE_SIZE, store: Optional[CandidateStore] = None):
+        self.maxsize = maxsize
+        self.store = store or CandidateStore()
+        self.dropped = 0
+        self._items = deque()
+        self._ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def _drop(self, item: dict):
+        self.dropped += 1
+        self.store.done(item["train_id"])
+
+    def mark_settled(self, train_id: str, track_id: int):
+        self.store.settle(train_id, track_id)
+        keep = deque()
+        for it in self._items:
+            if it["train_id"] == train_id and it["track_id"] == track_id:
+                self._drop(it)
+            else:
+                keep.append(it)
+        self._items = keep
+
+    def end_train(self, train_id: str):
+        """Tracker emitted train_end: the train's OCR state goes once its queued crops are done."""
+        self.store.end_train(train_id)
+
+    def put_nowait(self, item: dict):
+        self.store.expire()
+        if self.store.is_settled(item["train_id"], item["track_id"]):
+            self.dropped += 1
+            return
+        self.store.enqueued(item["train_id"])
+        if len(self._items) >= self.maxsize:
+            worst = max(range(len(self._items)), key=lambda i: self._items[i].get("rank", 0))
+            if item.get("rank", 0) >= self._items[worst].get("rank", 0):
+                self._drop(item)
+                return
+            self._drop(self._items[worst])
+            del self._items[worst]
+        self._items.append(item)
+        self._ready.set()
+
+    async def put(self, item: dict):
+        self.put_nowait(item)
+
+    async def get_batch(self, n: int) -> list:
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        batch = []
+        while self._items and len(batch) < n:
+            batch.append(self._items.popleft())
+        return batch
+
+    async def get(self) -> dict:
+        return (await self.get_batch(1))[0]
+
+# --- worker side: runs inside each pool process ---
+
+_worker_backend = None
+
+def _init_worker(name: str):
+    global _worker_backend
+    _worker_backend = load_backend(name)
+
+def _worker_backend_name() -> str:
+    return _worker_backend.name
+
+def _ocr_batch(images: list) -> list:
+    return [ocr_crop(_worker_backend, img) for img in images]
+
+def make_pool(workers: int = OCR_WORKERS):
+    """Process pool with one persistent OCR engine per worker (or a single thread if workers == 0)."""
+    if workers <= 0:
+        return ThreadPoolExecutor(1, initializer=_init_worker, initargs=(OCR_BACKEND,))
+    return ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(OCR_BACKEND,))
+
+def _insert_sighting(db, pass_id: Optional[int], train_id: str, track_id: int, number: str) -> Optional[int]:
+    """Runs on the DB executor. Writes the sighting; returns the TrainPass.id, or None if the train isn't in the DB."""
+    if pass_id is None:
+        tp = db.query(TrainPass.id).filter_by(train_id=train_id).first()
+        if not tp:
+            return None
+        pass_id = tp.id
+    db.add(EngineSighting(
+        train_pass_id=pass_id, track_id=track_id,
+        engine_number=number, first_seen_ts=datetime.now(timezone.utc)
+    ))
+    db.commit()
+    return pass_id
+
+async def _persist_sighting(store: CandidateStore, train_id: str, track_id: int, number: str) -> bool:
+    """Store to DB if not already stored; True if a new sighting was written.
+
+    Dedupe goes through the in-memory index; the DB is only asked for the
+    TrainPass.id, once per train. The store is only touched on the event loop.
+    """
+    if store.is_persisted(train_id, track_id, number):
+        return False
+    pass_id = await run_db(_insert_sighting, store.pass_id(train_id), train_id, track_id, number)
+    if pass_id is None:
+        return False
+    store.set_pass_id(train_id, pass_id)
+    store.mark_persisted(train_id, track_id, number)
+    return True
+
+async def _collect_results(inflight: asyncio.Queue, ocr_queue: CropQueue, event_queue):
+    """Applies batch results in dispatch order, so each track's crops are voted on best-first."""
+    store = ocr_queue.store
     while True:
-        item = await ocr_queue.get()
-        train_id = item["train_id"]
-        track_id = item["track_id"]
-        img = item["image"]
-
-        # Run preprocessing in thread
-        bw = await asyncio.to_thread(preprocess, img)
-        config = r"--psm 7 -c tessedit_char_whitelist=0123456789"
-        
-        # Run Tesseract in thread
-        text = await asyncio.to_thread(pytesseract.image_to_string, bw, config=config)
-        cand = DIGIT_RE.findall(text)
-        if cand:
-            cache[(train_id, track_id)].extend(cand)
-
-        # Commit if we have enough confidence (or after first hit)
-        votes = Counter(cache[(train_id, track_id)])
-        if votes:
-            number, n = votes.most_common(1)[0]
-            # Store to DB if not already stored
-            db = SessionLocal()
+        batch, fut = await inflight.get()
+        try:
+            results = await fut
+        except Exception as e:
+            print(f"OCR batch of {len(batch)} failed: {e}")
+            for item in batch:
+                store.done(item["train_id"])
+            continue
+        finally:
+            ocr_stats["inflight_batches"] -= 1
+        ocr_stats["batches"] += 1
+        ocr_stats["crops"] += len(batch)
+
+        for item, (text, t_pre, t_rec) in zip(batch, results):
+            train_id = item["train_id"]
+            track_id = item["track_id"]
+            stage_seconds.observe("ocr_preprocess", t_pre)
+            stage_seconds.observe("ocr_recognize", t_rec)
+            print(f"OCR {ocr_stats['backend']} {train_id}/{track_id}: preprocess {t_pre * 1000:.1f} ms, "
+                  f"recognize {t_rec * 1000:.1f} ms -> {text.strip()!r}")
             try:
-                tp = db.query(TrainPass).filter_by(train_id=train_id).first()
-                if tp:
-                    exists = db.query(EngineSighting).filter_by(
-                        train_pass_id=tp.id, track_id=track_id, engine_number=number
-                    ).first()
-                    if not exists:
-                        db.add(EngineSighting(
-                            train_pass_id=tp.id, track_id=track_id,
-                            engine_number=number, first_seen_ts=datetime.now(timezone.utc)
-                        ))
-                        db.commit()
-                        # Emit a non-blocking update—dashboard can show we recognized an engine number
-                        await event_queue.put({
-                            "event": "engine_number",
-                            "train_id": train_id,
-                            "track_id": track_id,
-                            "engine_number": number
-                        })
+                if store.is_settled(train_id, track_id):
+                    continue
+                # Commit once the vote reaches consensus, or take the winner after the track's last crop
+                votes = store.add_votes(train_id, track_id, DIGIT_RE.findall(text))
+                is_last = item.get("rank", 0) + 1 >= item.get("of", 1)
+                if not votes:
+                    continue
+                number, n = votes.most_common(1)[0]
+                if n < OCR_CONSENSUS and not is_last:
+                    continue
+                ocr_queue.mark_settled(train_id, track_id)
+                if await _persist_sighting(store, train_id, track_id, number):
+                    # Emit a non-blocking update—dashboard can show we recognized an engine number
+                    await event_queue.put({
+                        "event": "engine_number",
+                        "train_id": train_id,
+                        "track_id": track_id,
+                        "engine_number": number
+                    })
+            except Exception as e:
+                # e.g. "database is locked": lose this sighting, keep the collector alive
+                print(f"OCR result for {train_id}/{track_id} failed: {e}")
             finally:
-                db.close()
\ No newline at end of file
+                store.done(train_id)
+
+def _check_collector(collector: asyncio.Task):
+    """Raise if the result collector is gone; ocr_loop would otherwise block on a full inflight queue forever."""
+    if collector.done():
+        exc = None if collector.cancelled() else collector.exception()
+        raise RuntimeError(f"OCR result collector stopped: {exc!r}") from exc
+
+async def ocr_loop(ocr_queue: CropQueue, event_queue, workers: int = OCR_WORKERS):
+    """Dispatches locomotive crops to the OCR pool in small batches; results are voted on per track."""
+    # Each worker loads its OCR engine once; in-process backends keep their language data / templates resident.
+    # One probe per worker so the engines load now, in parallel with the model, not on the first crop.
+    loop = asyncio.get_running_loop()
+    pool = make_pool(workers)
+    ocr_stats["workers"] = max(1, workers)
+    names = await startup.timed("ocr", asyncio.gather(
+        *(loop.run_in_executor(pool, _worker_backend_name) for _ in range(ocr_stats["workers"]))))
+    ocr_stats["backend"] = names[0]
+    print(f"OCR pool: {ocr_stats['workers']} worker(s), backend {ocr_stats['backend']}")
+    print("Tesseract loaded completely") # User requested this output
+
+    # Bounded: at most two batches per worker in flight, the rest wait in ocr_queue
+    inflight = asyncio.Queue(maxsize=2 * ocr_stats["workers"])
+    collector = asyncio.create_task(_collect_results(inflight, ocr_queue, event_queue))
+    try:
+        while True:
+            batch = await ocr_queue.get_batch(OCR_BATCH_SIZE)
+            _check_collector(collector)
+            fut = loop.run_in_executor(pool, _ocr_batch, [it["image"] for it in batch])
+            ocr_stats["inflight_batches"] += 1
+            # Wait for room in inflight, unless the collector died and there never will be
+            put = asyncio.ensure_future(inflight.put((batch, fut)))
+            await asyncio.wait({put, collector}, return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                put.cancel()
+                _check_collector(collector)
+    except Exception as e:
+        print(f"OCR stopped: {e!r}")
+        startup.failed("ocr", e)
+        raise
+    finally:
+        collector.cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
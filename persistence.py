@@ -0,0 +1,192 @@
+import queue, threading, time
+from datetime import datetime, timezone
+from typing import Optional
+from db import SessionLocal, TrainPass, CarEvent
+from metrics import stage_seconds
+import rollup
+
+# CONFIG
+BATCH_SIZE = 50                # flush once this many writes are pending
+FLUSH_INTERVAL_S = 1.0         # ...or once the oldest pending write is this old
+RETRY_BASE_S = 0.5             # a failed batch stays pending and is retried after this, doubling each time
+RETRY_MAX_S = 30.0
+WRITE_RETRIES = 8              # ...this many times (~2 min), then writes go one by one and only failing ones are dropped
+
+_STOP = object()
+
+def _utc(ts: Optional[float]) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc) if ts is not None else datetime.now(timezone.utc)
+
+class PersistenceWriter:
+    """Write-behind persistence for TrainPass / CarEvent.
+
+    The tracker only enqueues; a dedicated thread applies the writes in batched
+    transactions (by size or on a timer), so SQLite I/O never runs on the event
+    loop. The active TrainPass.id is cached per train_id, so counting a car
+    needs no lookup query. Train start/end force an immediate flush, and
+    close() drains everything before returning. A batch that fails (e.g.
+    "database is locked") stays pending, with later writes queued behind it,
+    and is retried with backoff.
+    """
+    def __init__(self, session_factory=SessionLocal, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL_S, on_commit=None):
+        self._session_factory = session_factory
+        self._on_commit = on_commit   # called (from the writer thread) with the op kinds of each committed batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._q = queue.Queue()
+        self._pass_ids = {}   # train_id -> TrainPass.id, only for trains not yet ended
+        self._failures = 0
+        self._retry_at = 0.0  # after a failed batch: no new attempt before this
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    # --- producer side (called from the event loop; never blocks) ---
+
+    def train_start(self, train_id: str, ts: Optional[float] = None, camera: Optional[str] = None):
+        self._q.put(("start", train_id, _utc(ts), camera))
+
+    def car_event(self, train_id: str, track_id: int, klass: str, direction: str,
+                  ts: Optional[float] = None):
+        self._q.put(("car", train_id, track_id, klass, direction, _utc(ts)))
+
+    def train_end(self, train_id: str, summary: dict, ts: Optional[float] = None):
+        self._q.put(("end", train_id, summary, _utc(ts)))
+
+    def flush(self):
+        self._q.put(("flush",))
+
+    def close(self, timeout: float = 10.0):
+        """Final flush of everything queued so far, then stop the writer thread."""
+        if self._thread.is_alive():
+            self._q.put(_STOP)
+            self._thread.join(timeout)
+
+    # --- writer thread ---
+
+    def _run(self):
+        db = self._session_factory()
+        pending = []
+        deadline = 0.0
+        try:
+            while True:
+                timeout = max(0.0, max(deadline, self._retry_at) - time.monotonic()) if pending else None
+                try:
+                    op = self._q.get(timeout=timeout)
+                except queue.Empty:
+                    self._attempt(db, pending)   # timer expired
+                    continue
+                if op is _STOP:
+                    break
+                if op[0] != "flush":
+                    if not pending:
+                        deadline = time.monotonic() + self.flush_interval
+                    pending.append(op)
+                if op[0] in ("start", "end", "flush") or len(pending) >= self.batch_size:
+                    self._attempt(db, pending)
+            # Drain anything that raced in behind the stop marker
+            while True:
+                try:
+                    op = self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if op is not _STOP and op[0] != "flush":
+                    pending.append(op)
+            while pending:
+                time.sleep(max(0.0, self._retry_at - time.monotonic()))
+                self._attempt(db, pending)
+        finally:
+            db.close()
+
+    def _attempt(self, db, pending: list):
+        """Flush pending unless backing off after a failure; after WRITE_RETRIES, one write per transaction."""
+        if not pending or time.monotonic() < self._retry_at:
+            return
+        if self._flush(db, pending):
+            self._failures = 0
+            return
+        self._failures += 1
+        if self._failures > WRITE_RETRIES:
+            # Something in the batch keeps failing: write the ops one by one and only drop the bad ones
+            print(f"DB writer: {len(pending)} writes still failing after {WRITE_RETRIES} retries, "
+                  f"writing them one at a time")
+            for op in pending:
+                if not self._flush(db, [op]):
+                    print(f"DB writer: dropping {op[0]} write for {op[1]}")
+                    if op[0] == "end":
+                        self._pass_ids.pop(op[1], None)
+            pending.clear()
+            self._failures = 0
+            return
+        backoff = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (self._failures - 1))
+        self._retry_at = time.monotonic() + backoff
+        print(f"DB writer: retrying {len(pending)} writes in {backoff:.1f}s")
+
+    def _pass_id(self, db, train_id: str) -> Optional[int]:
+        pid = self._pass_ids.get(train_id)
+        if pid is None:
+            # e.g. train started before a restart; look it up once and cache it
+            tp = db.query(TrainPass.id).filter_by(train_id=train_id).first()
+            if tp is not None:
+                pid = self._pass_ids[train_id] = tp.id
+        return pid
+
+    def _flush(self, db, ops: list) -> bool:
+        """Apply ops in one transaction. On success ops is emptied; on failure it is left as it was."""
+        t0 = time.perf_counter()
+        try:
+            for op in ops:
+                kind, train_id = op[0], op[1]
+                if kind == "start":
+                    tp = TrainPass(train_id=train_id, start_ts=op[2], camera=op[3])
+                    db.add(tp); db.flush()
+                    self._pass_ids[train_id] = tp.id
+                elif kind == "car":
+                    _, _, track_id, klass, direction, ts = op
+                    pid = self._pass_id(db, train_id)
+                    if pid is None:
+                        print(f"DB writer: no TrainPass for {train_id}, dropping car event")
+                        continue
+                    db.add(CarEvent(train_pass_id=pid, track_id=track_id, klass=klass,
+                                    direction=direction, crossed_ts=ts))
+                elif kind == "end":
+                    _, _, summary, ts = op
+                    pid = self._pass_id(db, train_id)
+                    tp = db.get(TrainPass, pid) if pid is not None else None
+                    if tp is None:
+                        print(f"DB writer: no TrainPass for {train_id}, dropping train end")
+                        continue
+                    tp.end_ts = ts
+                    tp.direction = summary["direction"]
+                    tp.total_locomotives = summary["locomotive"]
+                    tp.total_railcars = summary["railcar"]
+                    tp.avg_speed_mph = summary["avg_speed_mph"]
+                    if summary.get("median_speed_mph") is not None:
+                        tp.extra = {**(tp.extra or {}), "median_speed_mph": summary["median_speed_mph"]}
+                    # Same transaction: the rollup never disagrees with train_pass
+                    rollup.add_train(db, tp)
+            db.commit()
+            stage_seconds.observe("db_write", time.perf_counter() - t0)
+        except Exception as e:
+            db.rollback()
+            print(f"DB writer: batch of {len(ops)} writes failed: {e}")
+            for op in ops:
+                if op[0] == "start":
+                    self._pass_ids.pop(op[1], None)   # id was rolled back with the batch
+            return False
+        finally:
+            db.expunge_all()
+        if self._on_commit is not None:
+            try:
+                self._on_commit({op[0] for op in ops})
+            except Exception as e:
+                print(f"DB writer: on_commit failed: {e}")
+        # Ended trains no longer need their cached id
+        for op in ops:
+            if op[0] == "end":
+                self._pass_ids.pop(op[1], None)
+        ops.clear()
+        return True
@@ -0,0 +1,115 @@
+"""Live annotated MJPEG preview, drawn from the tracker's own results (no second model or camera).
+
+Each camera has a PreviewHub. The counting stage offers it every frame; the
+hub ignores the offer unless someone is watching and PREVIEW_FPS says a frame
+is due, and then draws and JPEG-encodes it once on a background thread.
+Every /stream.mjpg viewer gets that same encoded frame, so the cost doesn't
+grow with the number of viewers, and nothing is encoded when nobody watches.
+"""
+import asyncio, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from metrics import Gauge
+
+# CONFIG
+PREVIEW_FPS = 5.0              # encoded preview frames per second, per camera
+PREVIEW_WIDTH = 640            # preview is downscaled to this width (never upscaled)
+PREVIEW_JPEG_QUALITY = 70
+BOUNDARY = "frame"
+
+CLASS_COLORS = {"locomotive": (0, 255, 0), "railcar": (255, 100, 0)}
+LINE_COLOR = (0, 0, 255)
+ROI_COLOR = (0, 200, 255)
+
+_encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+
+previews = {}   # camera name -> PreviewHub
+
+Gauge("preview_viewers", "Connected /stream.mjpg viewers.",
+      lambda: {n: h.viewers for n, h in previews.items()}, ("camera",))
+Gauge("preview_frames_encoded_total", "Preview JPEGs encoded (shared by all viewers).",
+      lambda: {n: h.encoded for n, h in previews.items()}, ("camera",), kind="counter")
+
+def annotate_and_encode(raw, xyxy, clss, ids, line_x: float, roi: Optional[tuple],
+                        class_map: dict, caption: str) -> bytes:
+    """Downscale, draw boxes / ids / count line / ROI, and return one JPEG."""
+    import cv2
+    h, w = raw.shape[:2]
+    scale = min(1.0, PREVIEW_WIDTH / w)
+    img = cv2.resize(raw, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else raw.copy()
+    lx = int(line_x * scale)
+    cv2.line(img, (lx, 0), (lx, img.shape[0]), LINE_COLOR, 2)
+    if roi is not None and tuple(roi) != (0, 0, w, h):
+        cv2.rectangle(img, (int(roi[0] * scale), int(roi[1] * scale)),
+                      (int(roi[2] * scale) - 1, int(roi[3] * scale) - 1), ROI_COLOR, 1)
+    for (x1, y1, x2, y2), cls_i, tid in zip(xyxy, clss, ids):
+        label = class_map.get(int(cls_i), "unknown")
+        color = CLASS_COLORS.get(label, (200, 200, 200))
+        p1, p2 = (int(x1 * scale), int(y1 * scale)), (int(x2 * scale), int(y2 * scale))
+        cv2.rectangle(img, p1, p2, color, 2)
+        cv2.putText(img, f"ID:{int(tid)} {label}", (p1[0], max(12, p1[1] - 5)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+    if caption:
+        cv2.putText(img, caption, (8, img.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY])
+    return buf.tobytes() if ok else b""
+
+class PreviewHub:
+    """Latest encoded preview frame of one camera, shared by all its viewers."""
+    def __init__(self, name: str, fps: float = PREVIEW_FPS):
+        self.name = name
+        self.interval = 1.0 / fps
+        self.viewers = 0
+        self.jpeg: Optional[bytes] = None
+        self.seq = 0
+        self.encoded = 0
+        self._next_due = 0.0
+        self._busy = False
+        self._changed: Optional[asyncio.Condition] = None
+
+    def _cond(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def offer(self, raw, xyxy, clss, ids, line_x, roi, class_map, caption: str = ""):
+        """Called from the counting stage for every frame; returns at once unless a preview frame is due."""
+        if not self.viewers or self._busy:
+            return
+        now = time.monotonic()
+        if now < self._next_due:
+            return
+        self._next_due = now + self.interval
+        self._busy = True
+        asyncio.get_running_loop().create_task(
+            self._encode(raw, xyxy, clss, ids, line_x, roi, class_map, caption))
+
+    async def _encode(self, *args):
+        try:
+            jpeg = await asyncio.get_running_loop().run_in_executor(_encoder, annotate_and_encode, *args)
+        except Exception as e:
+            print(f"Preview {self.name}: encode failed: {e}")
+            return
+        finally:
+            self._busy = False
+        if jpeg:
+            self.encoded += 1
+            async with self._cond():
+                self.jpeg, self.seq = jpeg, self.seq + 1
+                self._cond().notify_all()
+
+    async def frames(self):
+        """multipart/x-mixed-replace body for one viewer; always the newest frame, never a backlog."""
+        self.viewers += 1
+        seen = -1
+        try:
+            while True:
+                async with self._cond():
+                    await self._cond().wait_for(lambda: self.jpeg is not None and self.seq != seen)
+                    jpeg, seen = self.jpeg, self.seq
+                yield (f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                       f"Content-Length: {len(jpeg)}\r\n\r\n").encode() + jpeg + b"\r\n"
+        finally:
+            self.viewers -= 1
+            if not self.viewers:
+                self.jpeg = None   # don't show a stale frame to the next viewer
@@ -0,0 +1,178 @@
+"""Offline replay: run recorded video (or a directory of frames) through the tracker's counting logic.
+
+    python replay.py clips/eb_mixed.mp4
+    python replay.py clips/frames_dir --source-fps 15 --fps 8
+
+Without --fps frames are processed as fast as possible. With --fps the replay
+simulates a live camera at that rate: frames are paced in wall-clock time and
+any frame whose due time has already passed while inference was busy is
+dropped, just like the FrameRing does in tracker_loop.
+"""
+import argparse, json, os, time
+from typing import Optional
+
+import numpy as np
+
+import tracker
+from tracker import (StreamTracker, TrainSession, detect, load_model, resolve_roi, roi_imgsz,
+                     to_frame_coords)
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+DEFAULT_SOURCE_FPS = 30.0      # time base for frame directories / videos without fps metadata
+
+def iter_frames(source: str, source_fps: Optional[float] = None):
+    """Yield (offset_s, frame) for a video file or a directory of images (sorted by name)."""
+    import cv2
+    if os.path.isdir(source):
+        fps = source_fps or DEFAULT_SOURCE_FPS
+        names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTS))
+        for i, name in enumerate(names):
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None:
+                yield i / fps, frame
+        return
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise RuntimeError(f"Cannot open video {source}")
+    fps = source_fps or cap.get(cv2.CAP_PROP_FPS) or DEFAULT_SOURCE_FPS
+    try:
+        i = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield i / fps, frame
+            i += 1
+    finally:
+        cap.release()
+
+def percentiles(samples) -> dict:
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    a = np.asarray(samples) * 1000.0
+    p50, p90, p99 = np.percentile(a, [50, 90, 99])
+    return {"p50": round(float(p50), 2), "p90": round(float(p90), 2),
+            "p99": round(float(p99), 2), "max": round(float(a.max()), 2)}
+
+def replay(source: str, model=None, fps: Optional[float] = None,
+           source_fps: Optional[float] = None, roi=tracker.ROI) -> dict:
+    """Feed one clip through the same TrainSession logic as tracker_loop and report throughput and counts."""
+    if model is None:
+        model = load_model()
+    tracks = StreamTracker()
+
+    # Simulated clock: frame timestamps follow the clip's own time base
+    t0 = time.time()
+    session = TrainSession()
+    trains = []
+    timings = {"decode": [], "inference": [], "counting": []}
+    frames = dropped = 0
+    next_due = 0.0
+    area = imgsz = None   # resolved ROI, from the first frame
+
+    wall_start = time.perf_counter()
+    frame_iter = iter_frames(source, source_fps)
+    while True:
+        t_dec = time.perf_counter()
+        item = next(frame_iter, None)
+        if item is None:
+            break
+        offset, frame = item
+        t_decoded = time.perf_counter()
+
+        if fps:
+            # Live-camera simulation: a camera running at `fps` only captures some source frames
+            if offset < next_due:
+                continue
+            next_due = max(next_due, offset) + 1.0 / fps
+            # Wait for the frame's due time, drop it if inference made it stale already
+            lag = (time.perf_counter() - wall_start) - offset
+            if lag > 1.0 / fps:
+                dropped += 1
+                continue
+            if lag < 0:
+                time.sleep(-lag)
+        timings["decode"].append(t_decoded - t_dec)
+
+        t_inf = time.perf_counter()
+        if area is None:
+            area = resolve_roi(roi, frame.shape)
+            imgsz = roi_imgsz(area)
+        view = np.ascontiguousarray(frame[area[1]:area[3], area[0]:area[2]]) if roi is not None else frame
+        r = detect(model, [view], imgsz)[0]
+        xyxy, clss, ids, _ = tracks.update(r)
+        xyxy = to_frame_coords(xyxy, area)
+        timings["inference"].append(time.perf_counter() - t_inf)
+
+        t_cnt = time.perf_counter()
+        now = t0 + offset
+        session.observe(now, len(r.boxes) > 0)
+        if len(ids):
+            session.update(now, xyxy, clss, ids, area[2], area[0])
+        if session.maybe_end(now):
+            trains.append(session.summary())
+            session = TrainSession()
+            tracks.reset()   # same as the live tracker at train end
+        timings["counting"].append(time.perf_counter() - t_cnt)
+        frames += 1
+
+    elapsed = time.perf_counter() - wall_start
+    # Clip ended mid-train: close it out the same way END_TIMEOUT_S would
+    if session.active:
+        trains.append(session.summary())
+
+    return {
+        "source": source,
+        "frames": frames,
+        "dropped_frames": dropped,
+        "elapsed_s": round(elapsed, 3),
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {stage: percentiles(v) for stage, v in timings.items()},
+        "trains": trains,
+        "totals": {
+            "locomotive": sum(t["locomotive"] for t in trains),
+            "railcar": sum(t["railcar"] for t in trains),
+        },
+    }
+
+def parse_roi(text: str):
+    parts = text.split(",")
+    if len(parts) != 4:
+        raise argparse.ArgumentTypeError("ROI needs four comma-separated values")
+    return tuple(int(p) if p.strip() else None for p in parts)
+
+def print_report(res: dict):
+    print(f"{res['source']}: {res['frames']} frames in {res['elapsed_s']}s "
+          f"({res['fps']} fps, {res['dropped_frames']} dropped)")
+    for stage, p in res["latency_ms"].items():
+        print(f"  {stage:<10} p50={p['p50']}ms p90={p['p90']}ms p99={p['p99']}ms max={p['max']}ms")
+    for t in res["trains"]:
+        print(f"  {t['train_id']} {t['direction'] or '--'}: "
+              f"{t['locomotive']} locomotives, {t['railcar']} railcars")
+    print(f"  totals: {res['totals']['locomotive']} locomotives, {res['totals']['railcar']} railcars")
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded video through the train counter.")
+    ap.add_argument("source", help="video file or directory of frames")
+    ap.add_argument("--fps", type=float, default=None,
+                    help="simulate a live camera at this rate (default: as fast as possible)")
+    ap.add_argument("--source-fps", type=float, default=None,
+                    help=f"time base of the source (default: video metadata or {DEFAULT_SOURCE_FPS:g})")
+    ap.add_argument("--model", default=tracker.MODEL_PATH)
+    ap.add_argument("--backend", default=tracker.INFERENCE_BACKEND, choices=list(tracker.EXPORT_FORMATS))
+    ap.add_argument("--roi", type=parse_roi, default=tracker.ROI,
+                    help="x1,y1,x2,y2 region to run YOLO on; empty fields mean the frame edge (e.g. ',120,,360')")
+    ap.add_argument("--json", action="store_true", help="print the raw result as JSON")
+    args = ap.parse_args()
+
+    res = replay(args.source, load_model(args.model, backend=args.backend), fps=args.fps,
+                 source_fps=args.source_fps, roi=args.roi)
+    if args.json:
+        print(json.dumps(res, indent=2))
+    else:
+        print_report(res)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Daily/hourly per-direction rollup of finished trains (the train_rollup table).
+
+The write-behind writer calls add_train() in the same transaction that closes
+a TrainPass, so the rollup is always consistent with train_pass. For existing
+databases, or after editing train_pass by hand:
+
+    python rollup.py rebuild
+"""
+import argparse
+from datetime import timezone
+
+from db import SessionLocal, TrainPass, TrainRollup, init_db
+
+UNKNOWN_DIRECTION = "unknown"   # trains with no direction estimate
+LEGACY_UNKNOWN = "UNK"          # older rollups lumped NB/SB/no direction together under this
+
+def bucket(tp: TrainPass):
+    ts = tp.start_ts
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc)
+    direction = tp.direction or UNKNOWN_DIRECTION
+    return ts.strftime("%Y-%m-%d"), ts.hour, direction
+
+def add_train(db, tp: TrainPass):
+    """Add one finished train to its bucket. Caller commits."""
+    day, hour, direction = bucket(tp)
+    row = db.query(TrainRollup).filter_by(day=day, hour=hour, direction=direction).first()
+    if row is None:
+        row = TrainRollup(day=day, hour=hour, direction=direction, trains=0, cars=0,
+                          locomotives=0, speed_sum=0.0, speed_count=0)
+        db.add(row); db.flush()   # visible to the next add_train in this transaction
+    row.trains += 1
+    row.cars += tp.total_railcars or 0
+    row.locomotives += tp.total_locomotives or 0
+    if tp.avg_speed_mph is not None:
+        row.speed_sum += tp.avg_speed_mph
+        row.speed_count += 1
+
+def rebuild(db) -> int:
+    """Recompute the whole rollup from train_pass in one transaction; returns the number of buckets."""
+    buckets = {}
+    q = (db.query(TrainPass.start_ts, TrainPass.direction, TrainPass.total_railcars,
+                  TrainPass.total_locomotives, TrainPass.avg_speed_mph)
+           .filter(TrainPass.end_ts.isnot(None))
+           .execution_options(yield_per=1000))
+    for tp in q:
+        key = bucket(tp)
+        b = buckets.setdefault(key, [0, 0, 0, 0.0, 0])
+        b[0] += 1
+        b[1] += tp.total_railcars or 0
+        b[2] += tp.total_locomotives or 0
+        if tp.avg_speed_mph is not None:
+            b[3] += tp.avg_speed_mph
+            b[4] += 1
+
+    db.query(TrainRollup).delete()
+    db.add_all(TrainRollup(day=day, hour=hour, direction=direction, trains=n, cars=cars,
+                           locomotives=locos, speed_sum=ssum, speed_count=scount)
+               for (day, hour, direction), (n, cars, locos, ssum, scount) in buckets.items())
+    db.commit()
+    return len(buckets)
+
+def backfill_if_empty(db) -> bool:
+    """Build the rollup for databases created before it existed, or whose rollup still has "UNK" buckets."""
+    if db.query(TrainRollup.id).first() is not None:
+        if db.query(TrainRollup.id).filter_by(direction=LEGACY_UNKNOWN).first() is None:
+            return False
+    if db.query(TrainPass.id).filter(TrainPass.end_ts.isnot(None)).first() is None:
+        return False
+    rebuild(db)
+    return True
+
+def main():
+    ap = argparse.ArgumentParser(description="Maintain the train_rollup table.")
+    ap.add_argument("command", choices=["rebuild"])
+    ap.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        n = rebuild(db)
+        print(f"Rollup rebuilt: {n} buckets")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
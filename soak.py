@@ -0,0 +1,196 @@
+"""Memory / latency soak test for the counting state, in simulated time.
+
+Feeds TrainSession the way count_frame does with hours of synthetic tracks:
+long trains that stop, crawl and move again, with occasional ByteTrack id
+switches (a car losing its id and getting a new one) and dropouts, separated
+by idle gaps so trains end. Every --window simulated minutes it prints the
+update() latency, the per-track array capacity and live tracks, the
+session's array bytes and process RSS. It fails if the last third of the run
+is noticeably worse than the first.
+
+With --journal the run is also recorded as a detection journal (rotated at
+train ends, like count_frame does) and replayed both ways: it fails if the
+vectorized replay differs from --exact, or --exact from what was counted live.
+
+    python soak.py --hours 4
+    python soak.py --hours 8 --train-minutes 120 --bytetrack   # also step ultralytics' BYTETracker
+    python soak.py --hours 1 --train-minutes 5 --journal /tmp/soak-journal
+
+Runs much faster than real time (minutes for a multi-hour run).
+"""
+import argparse, os, sys, time
+
+import numpy as np
+
+import journal, tracker
+from loadtest import proc_usage
+from replay import percentiles
+
+# CONFIG
+FRAME_W = 640
+CAR_PITCH_PX = 100             # car spacing along the track
+CAR_WIDTH_PX = 90
+SPEED_PHASE_S = 30.0           # a new speed (stopped / crawling / moving) is picked this often
+ID_SWITCH_P = 0.002            # per car per frame: tracker loses the id and hands out a new one
+DROPOUT_P = 0.05               # per car per frame: missed detection
+
+def session_bytes(s: tracker.TrainSession) -> int:
+    return sum(v.nbytes for v in vars(s).values() if isinstance(v, np.ndarray))
+
+class SyntheticTrains:
+    """Boxes for long trains separated by idle gaps; ids churn like a real tracker's would."""
+    def __init__(self, rng, fps: float, train_minutes: float, gap_s: float):
+        self.rng, self.fps = rng, fps
+        self.train_frames = int(train_minutes * 60 * fps)
+        self.gap_frames = int(gap_s * fps)
+        self.next_id = 1
+        self.frame = 0
+        self._new_train()
+
+    def _new_train(self):
+        self.direction = self.rng.choice((-1, 1))
+        n = 4000   # more cars than any train can bring past the line
+        self.offsets = -np.arange(n) * CAR_PITCH_PX - CAR_WIDTH_PX
+        self.ids = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        self.cls = np.where(np.arange(n) < 3, 0, 1)
+        self.pos, self.v, self.t_in_train = 0.0, 0.0, 0
+
+    def next(self):
+        """(xyxy, cls, ids) for the next frame (empty during gaps)."""
+        self.frame += 1
+        cycle = self.train_frames + self.gap_frames
+        k = self.frame % cycle
+        if k == 0:
+            self._new_train()
+        if k >= self.train_frames:
+            return np.empty((0, 4)), np.empty(0, int), np.empty(0, int)
+        if k % int(SPEED_PHASE_S * self.fps) == 0:
+            # stopped / crawling / moving, in px per frame
+            self.v = self.rng.choice([0.0, self.rng.uniform(0.2, 1.5), self.rng.uniform(4, 10)], p=[0.3, 0.4, 0.3])
+        self.pos += self.v
+        x = self.offsets + self.pos
+        if self.direction < 0:
+            x = FRAME_W - x - CAR_WIDTH_PX
+        vis = (x + CAR_WIDTH_PX > 0) & (x < FRAME_W)
+        idx = np.flatnonzero(vis)
+        switch = idx[self.rng.random(len(idx)) < ID_SWITCH_P]
+        if len(switch):
+            self.ids[switch] = np.arange(self.next_id, self.next_id + len(switch))
+            self.next_id += len(switch)
+        idx = idx[self.rng.random(len(idx)) >= DROPOUT_P]
+        x1 = x[idx]
+        xyxy = np.stack([x1, np.full(len(idx), 100.0), x1 + CAR_WIDTH_PX, np.full(len(idx), 200.0)], axis=1)
+        return xyxy, self.cls[idx], self.ids[idx]
+
+def _bytetrack_step(st, xyxy, cls):
+    """Run boxes through a StreamTracker the way infer_batch does; returns its tracked ids."""
+    from types import SimpleNamespace
+    from ultralytics.engine.results import Boxes
+    data = np.concatenate([xyxy, np.full((len(xyxy), 1), 0.9), cls[:, None]], axis=1).astype(np.float32)
+    r = SimpleNamespace(boxes=Boxes(data, (360, FRAME_W)), orig_img=np.zeros((360, FRAME_W, 3), np.uint8))
+    return st.update(r)
+
+def soak(hours: float, fps: float, train_minutes: float, gap_s: float, window_min: float,
+         seed: int, bytetrack: bool, journal_root: str = None, live: list = None) -> list:
+    rng = np.random.default_rng(seed)
+    gen = SyntheticTrains(rng, fps, train_minutes, gap_s)
+    session = tracker.TrainSession()
+    st = tracker.StreamTracker(frame_rate=int(fps)) if bytetrack else None
+    jw = None
+    if journal_root:
+        jw = journal.JournalWriter(journal_root, "soak", {
+            "line_x": session.line_x, "pixels_per_foot": session.pixels_per_foot, "ltr": session.ltr,
+            "id_prefix": session.id_prefix, "frame_x0": 0, "frame_x1": FRAME_W})
+    now = 0.0
+    win_frames = int(window_min * 60 * fps)
+    rows, lat, trains = [], [], 0
+    for f in range(int(hours * 3600 * fps)):
+        now += 1.0 / fps
+        xyxy, cls, ids = gen.next()
+        t0 = time.perf_counter()
+        if st is not None:
+            xyxy, cls, ids, _ = _bytetrack_step(st, xyxy, cls)
+        if jw is not None:
+            jw.append(now, len(ids), xyxy, cls, ids, np.ones(len(ids)))
+        session.observe(now, len(ids) > 0)
+        if len(ids):
+            session.update(now, xyxy, cls, ids, FRAME_W)
+        if session.maybe_end(now):
+            trains += 1
+            if live is not None:
+                live.append({**session.summary(), "camera": "soak"})
+            session = tracker.TrainSession()
+            if st is not None:
+                st.reset()
+            if jw is not None:
+                jw.rotate(fresh=True)
+        lat.append(time.perf_counter() - t0)
+
+        if (f + 1) % win_frames == 0:
+            p = percentiles(lat)
+            rows.append({"sim_min": round(now / 60), "trains_ended": trains,
+                         "p50_us": round(p["p50"] * 1000, 1), "p99_us": round(p["p99"] * 1000, 1),
+                         "slots": len(session.slot_tid), "live": int((session.slot_tid >= 0).sum()),
+                         "session_kb": round(session_bytes(session) / 1024, 1),
+                         "bytetrack": (len(st._tracker.tracked_stracks) + len(st._tracker.lost_stracks)
+                                       + len(st._tracker.removed_stracks)) if st is not None else None,
+                         "rss_mb": round(proc_usage(os.getpid())[1] / 2**20, 1)})
+            print("  ".join(f"{k} {v}" for k, v in rows[-1].items() if v is not None), flush=True)
+            lat = []
+    if jw is not None:
+        jw.close()
+    if live is not None and session.active:
+        live.append({**session.summary(), "camera": "soak"})   # replay closes out a trailing train too
+    return rows
+
+def check_journal(root: str, live: list) -> list:
+    """Differences between live counting, the exact journal replay and the fast one."""
+    exact = journal.replay_journal(root, exact=True)["trains"]
+    diffs = [f"live vs exact: {d}" for d in journal.diff_trains(live, exact)]
+    return diffs + [f"exact vs fast: {d}" for d in journal.check_parity(root)]
+
+def check_flat(rows: list, tolerance: float) -> list:
+    """(metric, first third, last third) for metrics whose worst late value exceeds the early one by > tolerance."""
+    n = max(1, len(rows) // 3)
+    early, late = rows[:n], rows[-n:]
+    worse = []
+    for key in ("p99_us", "slots", "session_kb", "rss_mb", "bytetrack"):
+        if rows[0][key] is None:
+            continue
+        a, b = max(r[key] for r in early), max(r[key] for r in late)
+        if b > a * (1.0 + tolerance) + (1 if key == "bytetrack" else 0):
+            worse.append((key, a, b))
+    return worse
+
+def main():
+    ap = argparse.ArgumentParser(description="Memory/latency soak of the per-train counting state.")
+    ap.add_argument("--hours", type=float, default=4.0, help="simulated run length")
+    ap.add_argument("--fps", type=float, default=15.0)
+    ap.add_argument("--train-minutes", type=float, default=60.0, help="length of each (mostly crawling) train")
+    ap.add_argument("--gap", type=float, default=tracker.END_TIMEOUT_S + 20, help="idle seconds between trains")
+    ap.add_argument("--window", type=float, default=10.0, help="simulated minutes per report line")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--bytetrack", action="store_true", help="also run ultralytics' BYTETracker (needs ultralytics)")
+    ap.add_argument("--tolerance", type=float, default=0.5, help="allowed fractional growth, last third vs first")
+    ap.add_argument("--journal", metavar="DIR", help="also record a journal here and check replay parity (must be empty)")
+    args = ap.parse_args()
+
+    if args.journal and os.path.exists(args.journal) and os.listdir(args.journal):
+        sys.exit(f"{args.journal} is not empty")
+    live = [] if args.journal else None
+    rows = soak(args.hours, args.fps, args.train_minutes, args.gap, args.window, args.seed, args.bytetrack,
+                args.journal, live)
+    worse = check_flat(rows, args.tolerance)
+    for key, a, b in worse:
+        print(f"grew: {key} {a} -> {b}")
+    print("flat" if not worse else "NOT flat")
+    diffs = check_journal(args.journal, live) if args.journal else []
+    for d in diffs:
+        print(f"  {d}")
+    if args.journal:
+        print("replays match" if not diffs else f"{len(diffs)} replay differences")
+    sys.exit(1 if worse or diffs else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Startup progress of each subsystem, for /healthz, /readyz and the startup log.
+
+Subsystems (db, model, camera:<name>, ocr, ...) come up concurrently. Each
+reports when it starts, when it's ready or why it failed. Times are seconds
+since this module was imported, which is the first thing app.py does. The
+number that matters after a power blip is first_counted_frame_s: how long
+until the first frame went all the way through counting.
+"""
+import asyncio, time
+from typing import Optional
+
+T0 = time.monotonic()
+
+_subsystems = {}   # name -> {"state", "started_s", "ready_s", "error"}
+_first_frame_s: Optional[float] = None
+_expected = set()
+
+def _now() -> float:
+    return round(time.monotonic() - T0, 3)
+
+def expect(*names: str):
+    """Subsystems /readyz should wait for even before they've reported anything."""
+    _expected.update(names)
+
+def begin(name: str):
+    _subsystems[name] = {"state": "starting", "started_s": _now(), "ready_s": None, "error": None}
+
+def ready(name: str):
+    s = _subsystems.setdefault(name, {"state": "starting", "started_s": _now(), "error": None})
+    s["state"], s["ready_s"] = "ready", _now()
+    print(f"Startup: {name} ready after {s['ready_s']:.2f}s (took {s['ready_s'] - s['started_s']:.2f}s)")
+
+def failed(name: str, err):
+    s = _subsystems.setdefault(name, {"state": "starting", "started_s": _now(), "ready_s": None})
+    s["state"], s["error"] = "failed", str(err) or type(err).__name__
+
+def stopped(name: str):
+    if name in _subsystems:
+        _subsystems[name]["state"] = "stopped"
+
+def first_counted_frame():
+    """Called by the counting stage for every frame; records the first one."""
+    global _first_frame_s
+    if _first_frame_s is None:
+        _first_frame_s = _now()
+        print(f"Startup: first frame counted after {_first_frame_s:.2f}s")
+
+def is_ready() -> bool:
+    names = _expected | set(_subsystems)
+    return bool(names) and all(_subsystems.get(n, {}).get("state") == "ready" for n in names)
+
+def status() -> dict:
+    subs = {n: dict(_subsystems.get(n, {"state": "pending", "started_s": None, "ready_s": None, "error": None}))
+            for n in sorted(_expected | set(_subsystems))}
+    return {"ready": is_ready(), "uptime_s": _now(), "first_counted_frame_s": _first_frame_s,
+            "subsystems": subs}
+
+async def timed(name: str, aw):
+    """Await `aw` as subsystem `name`: records start, ready or failure."""
+    begin(name)
+    try:
+        out = await aw
+    except asyncio.CancelledError:
+        stopped(name)
+        raise
+    except Exception as e:
+        failed(name, e)
+        raise
+    ready(name)
+    return out
@@ -85,7 +85,18 @@ function connectWS() {
       setTotals({});
       refreshEnginesUI();
     }
-    if (data.event === "count") {
+    if (data.event === "snapshot") {
+      // Sent on connect while a train is passing
+      currentTrain = data.train_id;
+      engines = new Set(data.engine_numbers || []);
+      $("#activeTrain").textContent = currentTrain;
+      $("#direction").textContent = "—";
+      $("#speed").textContent = data.speed_mph ?? "—";
+      setTotals(data.totals || {});
+      refreshEnginesUI();
+    }
+    if (data.event === "count" && data.train_id === currentTrain) {
+      // With several cameras only the most recently started train is shown
       setTotals(data.totals || {});
       if (data.speed_mph !== undefined) {
         $("#speed").textContent = data.speed_mph;
@@ -106,6 +117,8 @@ function connectWS() {
       // You could also trigger a refresh of charts here
     }
   };
+  // Reconnect if the server drops us (e.g. we fell behind); the snapshot catches us up
+  ws.onclose = () => setTimeout(connectWS, 2000);
 }
 
 initCharts();
@@ -1,15 +1,26 @@
-import asyncio, time
+import asyncio, hashlib, heapq, itertools, json, os, shutil, threading, time
 from collections import defaultdict, deque
-from datetime import datetime, timezone
-from db import SessionLocal, TrainPass, CarEvent
+from broadcast import Broadcaster
+from journal import JOURNAL_DIR, JournalWriter
+from metrics import Gauge, stage_seconds
+from ocr_worker import CropQueue
+from persistence import PersistenceWriter
+from preview import PreviewHub, previews
+import startup
 from typing import Optional
 
+import numpy as np
+
 # Globals shared with app.py
-event_queue = asyncio.Queue()  # real-time events → dashboard
-ocr_queue = asyncio.Queue()    # locomotive crops → OCR worker
+event_queue = Broadcaster()    # real-time events → every dashboard (/ws) client
+ocr_queue = CropQueue()        # locomotive crops → OCR worker pool (bounded, never blocks)
 
 # CONFIG
 MODEL_PATH = "best.pt"
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "pytorch")   # see EXPORT_FORMATS
+EXPORT_DIR = "exports"         # exported models, cached per weights hash
+EXPORT_INT8_DATA = os.environ.get("EXPORT_INT8_DATA", "coco8.yaml")  # calibration set for INT8 exports
+WARMUP_RUNS = 2                # dummy inferences after loading (runs while the cameras open)
 LINE_X = 320                   # vertical count line in pixels (imgsz width assumed 640)
 CLASS_MAP = {0: "locomotive", 1: "railcar"} # Should this be {0: "engine", 1: "railcar"}? Though I am thinking of changing this on my next model fine tuning run.
 CONF = 0.25
@@ -18,251 +29,976 @@ START_FRAMES = 6               # frames with detections to call "train started"
 END_TIMEOUT_S = 8.0
 MIN_TRACK_FRAMES = 2           # require ≥2 frames before counting a track
 PIXELS_PER_FOOT = 12.0
+FRAME_RING_SIZE = 2            # captured frames waiting for inference (oldest dropped)
+RESULT_QUEUE_SIZE = 2          # inference results waiting for the counting stage
+OCR_TOP_N = 5                  # best crops per locomotive track sent to OCR
+CROP_LOST_FRAMES = 10          # frames a locomotive track must be unseen before its crops go to OCR
+CROP_REF_AREA = 200 * 100      # crops at least this big (px²) get no size penalty
+IDLE_FPS = 1.0                 # inference rate per camera while nothing moves near the line (0 = motion only)
+MOTION_BAND_PX = 160           # motion is checked this far either side of the count line
+MOTION_SCALE = 0.25            # motion check runs on a frame downscaled by this factor
+MOTION_PIXEL_DELTA = 25        # grey-level change that counts a pixel as moving
+MOTION_MIN_FRACTION = 0.01     # ...and this fraction of moving pixels counts as motion
+MOTION_BG_ALPHA = 0.05         # background running-average rate (lower = slow movers stand out longer)
+MOTION_HOLD_S = 3.0            # stay at full rate this long after the last motion
+CPU_REPORT_S = 600.0           # print idle/active CPU use this often
+ROI = None                     # (x1, y1, x2, y2) region sent to YOLO, None = whole frame; None edges = frame edge
+ROI_AUTO_IMGSZ = True          # shrink imgsz to the ROI's long side (multiple of 32) when it's under IMG_SIZE
 
 # EB/WB mapping for a vertical count line at x = LINE_X
-# dx = cx - prev_cx : positive means left->right
-def lr_to_compass(dx: float) -> str:
-    return "EB" if dx > 0 else "WB"
+# dx = cx - prev_cx : positive means left->right; `ltr` is the compass direction of left->right motion
+OPPOSITE = {"EB": "WB", "WB": "EB", "NB": "SB", "SB": "NB"}
+
+def lr_to_compass(dx: float, ltr: str = "EB") -> str:
+    return ltr if dx > 0 else OPPOSITE[ltr]
+
+# Class ids that get counted at the line
+COUNTED_CLASSES = np.array([k for k, v in CLASS_MAP.items() if v in ("locomotive", "railcar")])
+MPH_PER_FPS = 0.681818
+DX_WINDOW = 30                 # recent dx samples used for the direction estimate
+TRACK_SLOTS = 64               # initial per-track array capacity (grows by doubling)
+STALE_TRACK_FRAMES = 90        # forget a track unseen for this many frames (keep > ByteTrack's track_buffer)
+SPEED_BIN_MPH = 0.1            # resolution of the running median speed
+SPEED_MAX_MPH = 150            # speeds outside (0.1, SPEED_MAX_MPH) are discarded
+
+def speed_bins(v: np.ndarray) -> np.ndarray:
+    return np.minimum((v / SPEED_BIN_MPH).astype(np.int64), int(SPEED_MAX_MPH / SPEED_BIN_MPH))
+
+def hist_median(hist: np.ndarray, n: int) -> Optional[float]:
+    """Median of a speed histogram, to SPEED_BIN_MPH (bin centre)."""
+    if not n:
+        return None
+    b = int(np.searchsorted(np.cumsum(hist), (n + 1) // 2))
+    return round((b + 0.5) * SPEED_BIN_MPH, 2)
 
 class TrainSession:
-    def __init__(self):
+    """Per-train counting state.
+
+    Per-track state lives in NumPy arrays indexed by slot; `slot_tid` maps each
+    slot to the ByteTrack id occupying it (-1 = free). update() computes the
+    crossing mask, dx, speed and age for all boxes of a frame in one batch.
+    Slots of tracks unseen for STALE_TRACK_FRAMES updates are freed, and speed
+    is kept as a running sum plus histogram, so a train that crawls for hours
+    costs no more per frame or in memory than a short one.
+
+    start_frames / end_timeout / min_track_frames default to the module's
+    START_FRAMES / END_TIMEOUT_S / MIN_TRACK_FRAMES (the journal replay
+    passes its own).
+    """
+    def __init__(self, line_x: float = LINE_X, pixels_per_foot: float = PIXELS_PER_FOOT,
+                 ltr: str = "EB", id_prefix: str = "TP", start_frames: Optional[int] = None,
+                 end_timeout: Optional[float] = None, min_track_frames: Optional[int] = None):
+        self.line_x = line_x
+        self.pixels_per_foot = pixels_per_foot
+        self.ltr = ltr
+        self.id_prefix = id_prefix
+        self.start_frames = START_FRAMES if start_frames is None else start_frames
+        self.end_timeout = END_TIMEOUT_S if end_timeout is None else end_timeout
+        self.min_track_frames = MIN_TRACK_FRAMES if min_track_frames is None else min_track_frames
         self.active = False
         self.train_id: Optional[str] = None
         self.counts = defaultdict(int)
-        self.counted_ids = set()
-        self.last_center_x = {}
-        self.track_age = defaultdict(int)   # track_id -> frames seen
         self.last_detection_time = 0.0
-        self.start_buffer = deque(maxlen=START_FRAMES)
-        self.dx_buffer = deque(maxlen=30)   # collect dx for direction estimate
-        self.speeds = [] # list of calculated speeds (mph)
-        self.last_ts = {} # track_id -> last timestamp
-
-    def start(self):
+        self.start_buffer = deque(maxlen=self.start_frames)
+        self._reset_arrays()
+
+    def _reset_arrays(self):
+        self.slot_tid = np.full(TRACK_SLOTS, -1, dtype=np.int64)
+        self.last_center_x = np.full(TRACK_SLOTS, np.nan)
+        self.last_ts = np.full(TRACK_SLOTS, np.nan)
+        self.track_age = np.zeros(TRACK_SLOTS, dtype=np.int32)   # frames seen
+        self.counted = np.zeros(TRACK_SLOTS, dtype=bool)
+        self.dx_buffer = np.zeros(DX_WINDOW)   # ring of recent dx for direction estimate
+        self.dx_n = 0                          # total dx samples written
+        self.last_frame = np.zeros(TRACK_SLOTS, dtype=np.int64)   # update() call a slot's track was last seen in
+        self.frame_n = 0                       # update() calls so far
+        self.speed_hist = np.zeros(int(SPEED_MAX_MPH / SPEED_BIN_MPH) + 1, dtype=np.int64)
+        self.speed_sum = 0.0
+        self.n_speeds = 0
+
+    def start(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
         self.active = True
-        self.train_id = f"TP_{time.strftime('%Y%m%d_%H%M%S')}"
+        self.train_id = self._new_train_id(now)
         self.counts.clear()
-        self.counted_ids.clear()
-        self.last_center_x.clear()
-        self.track_age.clear()
         self.start_buffer.clear()
-        self.dx_buffer.clear()
-        self.speeds.clear()
-        self.last_ts.clear()
-        self.last_detection_time = time.time()
-
-    def maybe_end(self):
-        return self.active and (time.time() - self.last_detection_time) > END_TIMEOUT_S
+        self._reset_arrays()
+        self.last_detection_time = now
+
+    def _new_train_id(self, now: float) -> str:
+        return f"{self.id_prefix}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(now))}"
+
+    def observe(self, now: float, has_boxes: bool) -> bool:
+        """Train start logic: require a few consecutive "has detections". True if a train just started.
+
+        Any frame with detections also keeps the train alive, tracked or not:
+        a crawling train whose boxes ByteTrack hasn't confirmed must not time out.
+        """
+        self.start_buffer.append(1 if has_boxes else 0)
+        if has_boxes:
+            self.last_detection_time = now
+        if not self.active and sum(self.start_buffer) >= self.start_frames:
+            self.start(now)
+            return True
+        return False
+
+    def _grow(self, need: int):
+        cap = len(self.slot_tid)
+        new_cap = max(cap * 2, cap + need)
+        pad = new_cap - cap
+        self.slot_tid = np.concatenate([self.slot_tid, np.full(pad, -1, dtype=np.int64)])
+        self.last_center_x = np.concatenate([self.last_center_x, np.full(pad, np.nan)])
+        self.last_ts = np.concatenate([self.last_ts, np.full(pad, np.nan)])
+        self.track_age = np.concatenate([self.track_age, np.zeros(pad, dtype=np.int32)])
+        self.counted = np.concatenate([self.counted, np.zeros(pad, dtype=bool)])
+        self.last_frame = np.concatenate([self.last_frame, np.zeros(pad, dtype=np.int64)])
+
+    def _prune(self):
+        """Free the slots of tracks not seen in the last STALE_TRACK_FRAMES updates."""
+        stale = (self.slot_tid >= 0) & (self.frame_n - self.last_frame > STALE_TRACK_FRAMES)
+        if stale.any():
+            self.slot_tid[stale] = -1
+
+    def _slots_for(self, ids: np.ndarray) -> np.ndarray:
+        """Map track ids to slots, allocating fresh slots for ids not seen before."""
+        order = np.argsort(self.slot_tid)
+        sorted_tid = self.slot_tid[order]
+        pos = np.minimum(np.searchsorted(sorted_tid, ids), len(sorted_tid) - 1)
+        found = sorted_tid[pos] == ids
+        slots = np.where(found, order[pos], -1)
+
+        new = ~found
+        n_new = int(new.sum())
+        if n_new:
+            free = np.flatnonzero(self.slot_tid < 0)
+            if len(free) < n_new:
+                self._grow(n_new - len(free))
+                free = np.flatnonzero(self.slot_tid < 0)
+            fresh = free[:n_new]
+            self.slot_tid[fresh] = ids[new]
+            self.last_center_x[fresh] = np.nan
+            self.last_ts[fresh] = np.nan
+            self.track_age[fresh] = 0
+            self.counted[fresh] = False
+            slots[new] = fresh
+        self.last_frame[slots] = self.frame_n
+        return slots
+
+    def _push_dx(self, dx: np.ndarray):
+        dx = dx[-DX_WINDOW:]
+        idx = (self.dx_n + np.arange(len(dx))) % DX_WINDOW
+        self.dx_buffer[idx] = dx
+        self.dx_n += len(dx)
+
+    def _push_speeds(self, v: np.ndarray):
+        if len(v):
+            np.add.at(self.speed_hist, speed_bins(v), 1)
+            self.speed_sum += float(v.sum())
+            self.n_speeds += len(v)
+
+    def update(self, now: float, xyxy, clss, ids, frame_w: int, frame_x0: int = 0) -> list:
+        """Crossing, direction and speed logic for one frame of tracked boxes.
+
+        Returns one dict per box that crossed LINE_X this frame. If a crossing
+        happens before START_FRAMES was reached the train is started inline.
+        Boxes are in frame coordinates; frame_x0..frame_w is the part of the
+        frame that was actually searched (the ROI), used to skip cut-off boxes.
+        """
+        self.last_detection_time = now
+        xyxy = np.asarray(xyxy, dtype=np.float64)
+        clss = np.asarray(clss)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return []
+
+        x1, x2 = xyxy[:, 0], xyxy[:, 2]
+        cx = (x1 + x2) / 2.0
+        self.frame_n += 1
+        self._prune()
+        slots = self._slots_for(ids)
+
+        prev_cx = self.last_center_x[slots]
+        seen = ~np.isnan(prev_cx)
+        self.track_age[slots] += 1
+
+        # Keep dx history to estimate train's overall direction later
+        dx = cx - prev_cx
+        self._push_dx(dx[seen])
+
+        # Crossing check
+        crossed = (seen
+                   & (self.track_age[slots] >= self.min_track_frames)
+                   & ~self.counted[slots]
+                   & np.isin(clss, COUNTED_CLASSES)
+                   & (((prev_cx < self.line_x) & (self.line_x <= cx)) | ((prev_cx > self.line_x) & (self.line_x >= cx))))
+
+        # Speed: |dx| px -> feet -> ft/s -> mph, only if the object is fully inside the frame
+        dt = now - self.last_ts[slots]
+        inside = (x1 > frame_x0 + 1) & (x2 < frame_w - 1)
+        ok = crossed & inside & (dt > 0)
+        speed = np.zeros(len(ids))
+        speed[ok] = np.abs(dx[ok]) / self.pixels_per_foot / dt[ok] * MPH_PER_FPS
+        valid_speed = ok & (speed > 0.1) & (speed < SPEED_MAX_MPH)   # valid range filter
+        self._push_speeds(speed[valid_speed])
+
+        self.last_center_x[slots] = cx
+        self.last_ts[slots] = now
+
+        hits = np.flatnonzero(crossed)
+        if len(hits) == 0:
+            return []
+
+        # Python-level work only for boxes that actually crossed
+        self.counted[slots[hits]] = True
+        if not self.active:
+            # Ensure train is active before counting; unlike start() this keeps
+            # the per-track history so the car being counted isn't lost
+            self.active = True
+            self.train_id = self._new_train_id(now)
+
+        crossings = []
+        for i in hits:
+            label = CLASS_MAP[int(clss[i])]
+            self.counts[label] += 1
+            crossings.append({
+                "track_id": int(ids[i]),
+                "class": label,
+                "direction": lr_to_compass(dx[i], self.ltr),
+                "speed_mph": float(speed[i]),
+                "box": tuple(float(v) for v in xyxy[i]),
+            })
+        return crossings
+
+    def maybe_end(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        return self.active and (now - self.last_detection_time) > self.end_timeout
 
     def direction(self) -> Optional[str]:
-        if len(self.dx_buffer) < 5:
+        n = min(self.dx_n, DX_WINDOW)
+        if n < 5:
             return None
-        import numpy as np
-        avg = float(np.mean(self.dx_buffer))
-        return lr_to_compass(avg)
-
-train = TrainSession()
-
-async def tracker_loop():
-    # Give the server a moment to start up before we block the loop with heavy imports/init
-    await asyncio.sleep(1.0)
-    
-    # Offload heavy imports to thread to avoid blocking loop just in case
-    def load_heavy_imports():
+        avg = float(np.mean(self.dx_buffer[:n]))
+        return lr_to_compass(avg, self.ltr)
+
+    def avg_speed(self) -> Optional[float]:
+        if not self.n_speeds:
+            return None
+        return self.speed_sum / self.n_speeds
+
+    def median_speed(self) -> Optional[float]:
+        return hist_median(self.speed_hist, self.n_speeds)
+
+    def summary(self) -> dict:
+        return {
+            "train_id": self.train_id,
+            "direction": self.direction(),
+            "locomotive": self.counts.get("locomotive", 0),
+            "railcar": self.counts.get("railcar", 0),
+            "avg_speed_mph": self.avg_speed(),
+            "median_speed_mph": self.median_speed(),
+        }
+
+def crop_quality(crop, fully_inside: bool) -> float:
+    """Cheap OCR-worthiness score: sharpness (Laplacian variance) weighted by size and framing."""
+    import cv2
+    g = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    sharpness = float(cv2.Laplacian(g, cv2.CV_64F).var())
+    h, w = g.shape[:2]
+    score = sharpness * min(1.0, (w * h) / CROP_REF_AREA)
+    return score if fully_inside else score * 0.25
+
+class LocoCropCollector:
+    """Keeps the best OCR_TOP_N crops of every locomotive track while it is in view.
+
+    Once a counted locomotive has been out of view for CROP_LOST_FRAMES (or the
+    train ends) its crops are released best-first for OCR. Tracks that never
+    crossed the line are discarded.
+    """
+    def __init__(self, top_n: int = OCR_TOP_N, lost_frames: int = CROP_LOST_FRAMES):
+        self.top_n = top_n
+        self.lost_frames = lost_frames
+        self.frame = 0
+        self.cands = {}       # track_id -> min-heap of (score, seq, crop)
+        self.last_seen = {}   # track_id -> frame number
+        self.counted = {}     # track_id -> train_id, for locomotives that crossed the line
+        self._seq = itertools.count()
+
+    def tick(self):
+        """Advance one processed frame; call once per frame whether or not anything was detected."""
+        self.frame += 1
+
+    def observe(self, raw, xyxy, clss, ids, roi=None):
+        h, w = raw.shape[:2]
+        rx1, ry1, rx2, ry2 = roi or (0, 0, w, h)
+        for (x1, y1, x2, y2), cls_i, tid in zip(xyxy, clss, ids):
+            if CLASS_MAP.get(int(cls_i)) != "locomotive":
+                continue
+            tid = int(tid)
+            self.last_seen[tid] = self.frame
+            x1i, y1i = max(0, int(x1)), max(0, int(y1))
+            x2i, y2i = min(w, int(x2)), min(h, int(y2))
+            if x2i <= x1i or y2i <= y1i:
+                continue
+            crop = raw[y1i:y2i, x1i:x2i]
+            inside = x1 > rx1 + 1 and y1 > ry1 + 1 and x2 < rx2 - 1 and y2 < ry2 - 1
+            score = crop_quality(crop, inside)
+            heap = self.cands.setdefault(tid, [])
+            if len(heap) < self.top_n:
+                heapq.heappush(heap, (score, next(self._seq), crop.copy()))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, next(self._seq), crop.copy()))
+
+    def mark_counted(self, train_id: str, track_id: int):
+        self.counted[track_id] = train_id
+
+    def pop_ready(self, flush_all: bool = False) -> list:
+        """OCR queue items for locomotives that left the view, best crop first."""
+        out = []
+        for tid in list(self.last_seen):
+            if not flush_all and self.frame - self.last_seen[tid] <= self.lost_frames:
+                continue
+            del self.last_seen[tid]
+            heap = self.cands.pop(tid, [])
+            train_id = self.counted.pop(tid, None)
+            if train_id is None:
+                continue
+            ranked = sorted(heap, key=lambda c: c[0], reverse=True)
+            for rank, (score, _, crop) in enumerate(ranked):
+                out.append({"train_id": train_id, "track_id": tid, "image": crop,
+                            "score": round(score, 1), "rank": rank, "of": len(ranked)})
+        return out
+
+CAMERAS_FILE = os.environ.get("CAMERAS_FILE", "cameras.json")
+TRACKER_CFG = "bytetrack.yaml"
+TRACKER_FRAME_RATE = 30        # ByteTrack's notion of fps; only scales its lost-track buffer
+ULTRALYTICS_RANGE = ((8, 1), (8, 4))   # [min, max) versions whose ByteTrack internals StreamTracker uses (see requirements.txt)
+
+def load_cameras(path: str = CAMERAS_FILE) -> list:
+    """Camera definitions from CAMERAS_FILE, or the single USB camera at index 0 if it doesn't exist.
+
+    The file is a JSON list; only "name" and "source" are required:
+
+        [{"name": "east", "source": 0, "line_x": 320, "ltr": "EB", "pixels_per_foot": 12.0},
+         {"name": "west", "source": "rtsp://10.0.0.7/stream1", "ltr": "WB"}]
+
+    "ltr" is the compass direction a train moving left->right in that view is travelling.
+    """
+    if not os.path.exists(path):
+        return [{"name": "main", "source": 0}]
+    with open(path) as f:
+        cams = json.load(f)
+    names = [c["name"] for c in cams]
+    if not cams or len(set(names)) != len(names):
+        raise ValueError(f"{path}: need at least one camera and unique names")
+    for c in cams:
+        if c.get("ltr", "EB") not in OPPOSITE:
+            raise ValueError(f"{path}: camera {c['name']} has bad ltr {c['ltr']!r}")
+    return cams
+
+def resolve_roi(roi, shape) -> tuple:
+    """Clamp an (x1, y1, x2, y2) ROI (None entries = frame edge) to a frame of `shape`."""
+    h, w = shape[:2]
+    if roi is None:
+        return 0, 0, w, h
+    x1, y1, x2, y2 = [d if v is None else int(v) for v, d in zip(roi, (0, 0, w, h))]
+    x1, y1 = max(0, min(x1, w - 1)), max(0, min(y1, h - 1))
+    x2, y2 = max(x1 + 1, min(x2, w)), max(y1 + 1, min(y2, h))
+    return x1, y1, x2, y2
+
+def roi_imgsz(roi: tuple) -> int:
+    """Inference size for an ROI: its long side rounded up to a multiple of 32, never above IMG_SIZE."""
+    if not ROI_AUTO_IMGSZ:
+        return IMG_SIZE
+    long_side = max(roi[2] - roi[0], roi[3] - roi[1])
+    return min(IMG_SIZE, -(-long_side // 32) * 32)
+
+class MotionGate:
+    """Cheap "is anything moving near the count line" check, run on every captured frame.
+
+    Differences a downscaled grey band around the line against a running-average
+    background, so even a slowly creeping train shows up. Costs well under a
+    millisecond per frame, against tens of milliseconds for YOLO on CPU.
+    """
+    def __init__(self, line_x: float, band: int = MOTION_BAND_PX, hold_s: float = MOTION_HOLD_S):
+        self.line_x = line_x
+        self.band = band
+        self.hold_s = hold_s
+        self.bg = None
+        self.last_motion = float("-inf")
+
+    def update(self, raw, ts: float) -> bool:
+        """Feed a frame; True while there was motion within the last hold_s seconds."""
         import cv2
-        from ultralytics import YOLO
+        w = raw.shape[1]
+        x1 = int(max(0, min(w - 1, self.line_x - self.band)))
+        x2 = int(min(w, max(x1 + 1, self.line_x + self.band)))
+        g = cv2.cvtColor(raw[:, x1:x2], cv2.COLOR_BGR2GRAY)
+        g = cv2.resize(g, None, fx=MOTION_SCALE, fy=MOTION_SCALE, interpolation=cv2.INTER_AREA)
+        g = cv2.GaussianBlur(g, (5, 5), 0).astype(np.float32)
+        if self.bg is None or self.bg.shape != g.shape:
+            self.bg = g
+            return ts - self.last_motion <= self.hold_s
+        moving = np.count_nonzero(cv2.absdiff(g, self.bg) > MOTION_PIXEL_DELTA)
+        cv2.accumulateWeighted(g, self.bg, MOTION_BG_ALPHA)
+        if moving >= MOTION_MIN_FRACTION * g.size:
+            self.last_motion = ts
+        return ts - self.last_motion <= self.hold_s
+
+class CpuMeter:
+    """Process CPU time split by whether any camera was running at full rate."""
+    def __init__(self):
+        self.stats = {"idle": {"cpu_s": 0.0, "wall_s": 0.0}, "active": {"cpu_s": 0.0, "wall_s": 0.0}}
+        self._cpu = time.process_time()
+        self._wall = time.monotonic()
+        self._last_report = self._wall
+        self._active = True
+
+    def tick(self, active: bool):
+        """Charge the time since the last tick to the previous mode, then switch to `active`."""
+        cpu, wall = time.process_time(), time.monotonic()
+        st = self.stats["active" if self._active else "idle"]
+        self._active = active
+        st["cpu_s"] += cpu - self._cpu
+        st["wall_s"] += wall - self._wall
+        self._cpu, self._wall = cpu, wall
+        if wall - self._last_report >= CPU_REPORT_S:
+            self._last_report = wall
+            print(f"CPU use: {self.report()}")
+
+    def report(self) -> str:
+        # Percent of one core, as `top` shows it
+        parts = []
+        for mode, st in self.stats.items():
+            pct = 100.0 * st["cpu_s"] / st["wall_s"] if st["wall_s"] else 0.0
+            parts.append(f"{mode} {pct:.0f}% over {st['wall_s']:.0f}s")
+        return ", ".join(parts)
+
+cpu_meter = CpuMeter()
+
+def _bytetrack_api():
+    """The non-public ultralytics pieces StreamTracker drives directly.
+
+    They are not a stable API, so an incompatible ultralytics fails here, when
+    the trackers are built at startup, with the supported range in the message.
+    """
+    from importlib.metadata import PackageNotFoundError, version
+    try:
+        installed = version("ultralytics")
+    except PackageNotFoundError:
+        installed = "not installed"
+    lo, hi = (".".join(map(str, v)) for v in ULTRALYTICS_RANGE)
+    try:
+        from ultralytics.trackers.basetrack import BaseTrack
+        from ultralytics.trackers.byte_tracker import BYTETracker
+        from ultralytics.utils import IterableSimpleNamespace
+        from ultralytics.utils.checks import check_yaml
+        try:
+            from ultralytics.utils import yaml_load
+        except ImportError:
+            from ultralytics.utils import YAML   # newer releases
+            yaml_load = YAML.load
+        if not hasattr(BaseTrack, "_count") or not hasattr(BYTETracker, "reset"):
+            raise ImportError("BaseTrack._count / BYTETracker.reset are gone")
+    except ImportError as e:
+        raise RuntimeError(f"StreamTracker needs ultralytics >={lo},<{hi} (uses its ByteTrack internals); "
+                           f"installed: {installed} ({e})") from e
+    parsed = tuple(int(p) for p in installed.split(".")[:2] if p.isdigit())
+    if not ULTRALYTICS_RANGE[0] <= parsed < ULTRALYTICS_RANGE[1]:
+        print(f"Warning: ultralytics {installed} is outside the tested range >={lo},<{hi} for StreamTracker")
+    return BaseTrack, BYTETracker, IterableSimpleNamespace, yaml_load, check_yaml
+
+class StreamTracker:
+    """Per-camera ByteTrack state fed from plain (batched) detections.
+
+    ultralytics' model.track() keeps one tracker per batch slot and assumes the
+    same stream in every call, so with several cameras sharing one predict()
+    batch each stream owns its own BYTETracker instead.
+    """
+    def __init__(self, frame_rate: int = TRACKER_FRAME_RATE):
+        self._base_track, BYTETracker, IterableSimpleNamespace, yaml_load, check_yaml = _bytetrack_api()
+        cfg = IterableSimpleNamespace(**yaml_load(check_yaml(TRACKER_CFG)))
+        self._tracker = BYTETracker(cfg, frame_rate=frame_rate)
+
+    def reset(self):
+        """Drop every track (at train end) so lost/removed tracks don't pile up between trains."""
+        # reset() also rewinds the id counter, which is shared by every camera's tracker; ids only need to be unique
+        next_id = self._base_track._count
+        self._tracker.reset()
+        self._base_track._count = next_id
+
+    def update(self, r):
+        """Step the tracker with one frame's detections; returns (xyxy, classes, track_ids, confs) of confirmed tracks."""
+        det = r.boxes.cpu().numpy()
+        tracks = self._tracker.update(det, r.orig_img)
+        if len(tracks) == 0:
+            return np.empty((0, 4), np.float32), np.empty(0, int), np.empty(0, int), np.empty(0, np.float32)
+        # rows: x1, y1, x2, y2, track_id, score, cls, det_idx
+        return tracks[:, :4], tracks[:, 6].astype(int), tracks[:, 4].astype(int), tracks[:, 5]
+
+class FrameRing:
+    """Small drop-oldest buffer between the capture thread and inference.
+
+    Each entry is (capture_ts, frame). Inference always takes the newest frame
+    and discards anything older, so it never works through a backlog.
+    """
+    def __init__(self, size: int = FRAME_RING_SIZE, ready: Optional[threading.Event] = None):
+        self._frames = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._ready = ready   # shared across cameras: set whenever any ring gets a frame
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, ts: float, frame):
+        with self._cond:
+            if len(self._frames) == self._frames.maxlen:
+                self.dropped += 1
+            self._frames.append((ts, frame))
+            self._cond.notify()
+        if self._ready is not None:
+            self._ready.set()
+
+    def latest(self, timeout: Optional[float] = None):
+        with self._cond:
+            if not self._frames and not self.closed:
+                self._cond.wait(timeout)
+            if not self._frames:
+                return None
+            item = self._frames.pop()
+            self.dropped += len(self._frames)
+            self._frames.clear()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self._ready is not None:
+            self._ready.set()
+
+def capture_worker(cam, ring: FrameRing, stop: threading.Event):
+    """Dedicated capture thread: keeps draining the camera so the driver buffer never fills up."""
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        ret, frame = cam.read()
+        ts = time.time()
+        stage_seconds.observe("capture", time.perf_counter() - t0)
+        if not ret:
+            # If camera fails, wait a bit and try again
+            time.sleep(0.1)
+            continue
+        ring.put(ts, frame)
+    ring.close()
+
+class CameraStream:
+    """One camera: its capture thread and ring plus its own tracker, TrainSession and crop collector."""
+    def __init__(self, cfg: dict, ready: threading.Event, multi: bool = False):
+        self.name = cfg["name"]
+        self.source = cfg["source"]
+        self.line_x = cfg.get("line_x", LINE_X)
+        self.ltr = cfg.get("ltr", "EB")
+        self.pixels_per_foot = cfg.get("pixels_per_foot", PIXELS_PER_FOOT)
+        # Single-camera installs keep the old TP_<timestamp> train ids
+        self.id_prefix = f"TP_{self.name}" if multi else "TP"
+        self.ring = FrameRing(FRAME_RING_SIZE, ready)
+        self.roi_cfg = cfg.get("roi", ROI)
+        self.roi: Optional[tuple] = None   # resolved against the first frame
+        self.imgsz = IMG_SIZE
+        self.tracks: Optional[StreamTracker] = None
+        self.reset_tracks = False  # set at train end; the inference thread resets the tracker before its next update
+        self.gate = MotionGate(self.line_x) if cfg.get("motion_gate", True) else None
+        self.full_rate = True     # False while idling at IDLE_FPS
+        self.last_infer_ts = float("-inf")
+        self.last_n_det = 0
+        self.n_tracks = 0          # confirmed tracks in the last processed frame
+        self.fps = 0.0             # processed frames per second (EWMA)
+        self._last_frame_ts = None
+        self.journal: Optional[JournalWriter] = None   # created on the first frame, once the ROI is known
+        self.preview = previews[self.name] = PreviewHub(self.name)
+        self.train = self.new_session()
+        self.crops = LocoCropCollector()
+        self.cam = None
+        self.capture: Optional[threading.Thread] = None
+
+    def new_session(self) -> TrainSession:
+        return TrainSession(self.line_x, self.pixels_per_foot, self.ltr, self.id_prefix)
+
+    def wants_inference(self, ts: float, raw) -> bool:
+        """Motion gate: every frame while something moves or a train is (maybe) passing, else IDLE_FPS.
+
+        Skipped frames never reach TrainSession, so START_FRAMES still counts
+        consecutive inferred frames; any detection, pending start or active
+        train forces full rate, so a train is never started or ended at the
+        idle rate.
+        """
+        moving = self.gate.update(raw, ts) if self.gate is not None else True
+        train = self.train
+        self.full_rate = (moving or self.last_n_det > 0 or train.active or any(train.start_buffer))
+        if self.full_rate or (IDLE_FPS > 0 and ts - self.last_infer_ts >= 1.0 / IDLE_FPS):
+            self.last_infer_ts = ts
+            return True
+        return False
+
+    def journal_meta(self) -> dict:
+        return {"line_x": self.line_x, "ltr": self.ltr, "pixels_per_foot": self.pixels_per_foot,
+                "id_prefix": self.id_prefix, "frame_x0": self.roi[0], "frame_x1": self.roi[2]}
+
+    def view(self, raw):
+        """The part of the frame YOLO sees (a copy of the ROI, or the frame itself)."""
+        if self.roi is None:
+            self.roi = resolve_roi(self.roi_cfg, raw.shape)
+            self.imgsz = roi_imgsz(self.roi)
+            if not self.roi[0] <= self.line_x < self.roi[2]:
+                print(f"Camera {self.name}: count line x={self.line_x} is outside ROI {self.roi}")
+            print(f"Camera {self.name}: ROI {self.roi}, imgsz {self.imgsz}")
+        x1, y1, x2, y2 = self.roi
+        if (x1, y1) == (0, 0) and (y2, x2) == raw.shape[:2]:
+            return raw
+        return np.ascontiguousarray(raw[y1:y2, x1:x2])
+
+    def open(self, cv2):
+        self.cam = cv2.VideoCapture(self.source)
+        if not self.cam.isOpened():
+            raise RuntimeError(f"Camera {self.name} ({self.source}) not found.")
+        # Keep the driver-side queue as short as possible; buffering happens in FrameRing
+        self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # Warm-up read so we fail fast if the camera opened but produces nothing
+        ret, _ = self.cam.read()
+        if not ret:
+            raise RuntimeError(f"Failed to grab frame from camera {self.name}.")
+
+    def start_capture(self, stop: threading.Event):
+        self.capture = threading.Thread(target=capture_worker, args=(self.cam, self.ring, stop),
+                                        name=f"capture-{self.name}", daemon=True)
+        self.capture.start()
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.join(2.0)
+        if self.cam is not None:
+            self.cam.release()
+
+# Backend name -> ultralytics export() arguments. Dynamic exports accept any
+# imgsz/batch (ROI sizes, several cameras); static ones always run at IMG_SIZE.
+EXPORT_FORMATS = {
+    "pytorch": None,
+    "torchscript": {"format": "torchscript"},
+    "onnx": {"format": "onnx", "dynamic": True, "simplify": True},
+    "openvino": {"format": "openvino", "dynamic": True},
+    "openvino-int8": {"format": "openvino", "int8": True},
+}
+
+def weights_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def export_model(path: str, backend: str) -> str:
+    """Path of `path` exported for `backend`, exporting only if this exact weights file hasn't been before."""
+    from ultralytics import YOLO
+    args = dict(EXPORT_FORMATS[backend])
+    cache = os.path.join(EXPORT_DIR, f"{os.path.splitext(os.path.basename(path))[0]}-{weights_hash(path)}-{backend}")
+    if os.path.isdir(cache) and os.listdir(cache):
+        return os.path.join(cache, os.listdir(cache)[0])
+
+    print(f"Exporting {path} for {backend} (one-time)...")
+    if args.get("int8"):
+        args["data"] = EXPORT_INT8_DATA
+    out = YOLO(path).export(imgsz=IMG_SIZE, **args)
+    # Export writes next to the weights; move it into the cache so the next hash gets its own copy
+    tmp = cache + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    shutil.move(str(out), os.path.join(tmp, os.path.basename(str(out))))
+    os.replace(tmp, cache)
+    return os.path.join(cache, os.path.basename(str(out)))
+
+def warmup(model, runs: int = WARMUP_RUNS):
+    """Pay the first-inference cost (graph build, allocations) now instead of on the first train."""
+    frame = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+    for _ in range(runs):
+        detect(model, [frame])
+
+camera_streams = []   # the running CameraStreams, for /metrics
+
+def _per_camera(attr):
+    return lambda: {s.name: getattr(s, attr) for s in camera_streams}
+
+Gauge("event_queue_depth", "Deepest /ws subscriber backlog.", event_queue.qsize)
+Gauge("ws_clients", "Connected /ws clients.", lambda: len(event_queue.subscribers))
+Gauge("ws_dropped_clients_total", "/ws clients dropped for falling behind.",
+      lambda: event_queue.dropped_clients, kind="counter")
+Gauge("ocr_queue_depth", "Locomotive crops waiting for OCR.", ocr_queue.qsize)
+Gauge("active_tracks", "Confirmed tracks in the last processed frame.", _per_camera("n_tracks"), ("camera",))
+Gauge("fps", "Frames processed per second (includes idle-rate periods).", _per_camera("fps"), ("camera",))
+Gauge("full_rate", "1 while a camera is inferring every frame, 0 while idling.", _per_camera("full_rate"), ("camera",))
+Gauge("dropped_frames_total", "Captured frames never inferred (ring overflow / stale).",
+      lambda: {s.name: s.ring.dropped for s in camera_streams}, ("camera",), kind="counter")
+Gauge("train_active", "1 while a train is passing.",
+      lambda: {s.name: s.train.active for s in camera_streams}, ("camera",))
+Gauge("cpu_seconds_total", "Process CPU time, split by idle / full-rate inference.",
+      lambda: {m: st["cpu_s"] for m, st in cpu_meter.stats.items()}, ("mode",), kind="counter")
+
+def load_model(path: str = MODEL_PATH, backend: str = INFERENCE_BACKEND, warm: bool = True):
+    """Load the YOLO weights for `backend`: PyTorch on the best available device, or a cached CPU export."""
+    from ultralytics import YOLO
+    if backend not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {backend!r}; choose from {', '.join(EXPORT_FORMATS)}")
+    t0 = time.perf_counter()
+    if EXPORT_FORMATS[backend] is None:
         from ultralytics.utils.torch_utils import select_device
-        return cv2, YOLO, select_device
-
-    cv2, YOLO, select_device = await asyncio.to_thread(load_heavy_imports)
-    print("OpenCV loaded and ready to capture video") # User requested this specific message for OpenCV load/ready
-
-    global train
-    # Select device (GPU/NPU/CPU)
-    device = select_device('')
-    print(f"Using device: {device}")
-
-    # Load model in thread with device
-    model = await asyncio.to_thread(YOLO, MODEL_PATH)
-    model.to(device)
-    
-    cap = 0  # USB camera index
-    last_frame = None
-
-    # Use stream=True for generator; but we also need the raw frame for OCR crops.
-    # We'll open a parallel OpenCV capture for frames.
-    # Open camera in thread
-    cam = await asyncio.to_thread(cv2.VideoCapture, cap)
-    
-    if not cam.isOpened():
-        raise RuntimeError("USB camera not found.")
-    
-    print("Camera loaded") # User requested this output
-
-    # Warm-up read to know resolution; we’ll resize to IMG_SIZE width downstream if needed.
-    ret, frame = await asyncio.to_thread(cam.read)
-    if not ret:
-        raise RuntimeError("Failed to grab frame from camera.")
-    h0, w0 = frame.shape[:2]
-
-    # Kick off model tracking generator (uses its own capture on source=0)
-    # gen = model.track(source=cap, tracker="bytetrack.yaml",
-    #                   conf=CONF, imgsz=IMG_SIZE, persist=True, stream=True)
-
-    db = SessionLocal()
-
+        device = select_device('')
+        print(f"Using device: {device}")
+        model = YOLO(path)
+        model.to(device)
+    else:
+        artifact = export_model(path, backend)
+        print(f"Using {backend} model: {artifact}")
+        model = YOLO(artifact, task="detect")
+        if not EXPORT_FORMATS[backend].get("dynamic"):
+            model.fixed_imgsz = IMG_SIZE
+    if warm:
+        warmup(model)
+    print(f"Model ready in {time.perf_counter() - t0:.1f}s")
+    return model
+
+def detect(model, frames: list, imgsz: int = IMG_SIZE) -> list:
+    """One batched YOLO call over frames from any number of cameras; one Results per frame."""
+    fixed = getattr(model, "fixed_imgsz", None)
+    if fixed:
+        # Static exports only take their own size and a batch of one
+        return [r for f in frames
+                for r in model.predict([f], conf=CONF, imgsz=fixed, verbose=False, device=model.device)]
+    return model.predict(frames, conf=CONF, imgsz=imgsz, verbose=False, device=model.device)
+
+def to_frame_coords(xyxy, roi: tuple):
+    """Shift boxes found in an ROI crop back into full-frame pixels."""
+    if roi[0] == 0 and roi[1] == 0:
+        return xyxy
+    return xyxy + np.array([roi[0], roi[1], roi[0], roi[1]], dtype=xyxy.dtype)
+
+def gather_frames(streams: list, ready: threading.Event, timeout: float) -> list:
+    """Wait until at least one camera has a frame, then take the newest frame from every camera whose motion gate lets it through."""
+    ready.wait(timeout)
+    ready.clear()
+    batch = []
+    for s in streams:
+        item = s.ring.latest(0)
+        if item is not None and s.wants_inference(*item):
+            batch.append((s, *item))
+    return batch
+
+def infer_batch(model, batch: list) -> list:
+    """Detect on the whole batch at once (one call per distinct imgsz), then step each camera's own tracker."""
+    views = [s.view(raw) for s, _, raw in batch]
+    results = [None] * len(batch)
+    by_size = {}
+    for i, (s, _, _) in enumerate(batch):
+        by_size.setdefault(s.imgsz, []).append(i)
+    t0 = time.perf_counter()
+    for imgsz, idx in by_size.items():
+        for i, r in zip(idx, detect(model, [views[i] for i in idx], imgsz)):
+            results[i] = r
+    stage_seconds.observe("inference", time.perf_counter() - t0)
+
+    out = []
+    for (s, ts, raw), r in zip(batch, results):
+        t0 = time.perf_counter()
+        if s.reset_tracks:
+            s.tracks.reset()
+            s.reset_tracks = False
+        xyxy, clss, ids, conf = s.tracks.update(r)
+        xyxy = to_frame_coords(xyxy, s.roi)
+        stage_seconds.observe("track", time.perf_counter() - t0)
+        s.last_n_det = len(r.boxes)
+        out.append((s, ts, raw, len(r.boxes), xyxy, clss, ids, conf))
+    return out
+
+async def inference_stage(model, streams: list, ready: threading.Event, results_q: asyncio.Queue):
+    """Runs YOLO on the freshest frame of every camera in one batch per tick and hands results to counting."""
+    while True:
+        batch = await asyncio.to_thread(gather_frames, streams, ready, 0.5)
+        cpu_meter.tick(any(s.full_rate for s in streams))
+        if not batch:
+            if all(s.ring.closed for s in streams):
+                break
+            continue
+
+        # Run inference in thread
+        out = await asyncio.to_thread(infer_batch, model, batch)
+
+        # Bounded hand-off: if counting falls behind, inference waits here and
+        # the rings keep only the newest frames in the meantime.
+        for item in out:
+            await results_q.put(item)
+
+async def _start_train_pass(writer: PersistenceWriter, s: CameraStream, now: float):
+    writer.train_start(s.train.train_id, now, camera=s.name)
+    await event_queue.put({"event": "train_start", "train_id": s.train.train_id,
+                           "camera": s.name, "ts": now})
+
+async def count_frame(s: CameraStream, writer: PersistenceWriter, now: float, raw,
+                      n_det: int, xyxy, clss, ids, conf):
+    """Crossing, direction and speed logic for one camera's frame."""
+    t0 = time.perf_counter()
+    if JOURNAL_DIR:
+        if s.journal is None:
+            s.journal = JournalWriter(JOURNAL_DIR, s.name, s.journal_meta())
+        s.journal.append(now, n_det, xyxy, clss, ids, conf)
+    train, crops = s.train, s.crops
+    crops.tick()
+    s.n_tracks = len(ids)
+    if s._last_frame_ts is not None and now > s._last_frame_ts:
+        s.fps = 0.9 * s.fps + 0.1 / (now - s._last_frame_ts)
+    s._last_frame_ts = now
+
+    if train.observe(now, n_det > 0):
+        await _start_train_pass(writer, s, now)
+
+    if len(ids):
+        was_active = train.active
+        crossings = train.update(now, xyxy, clss, ids, s.roi[2], s.roi[0])
+        if crossings and not was_active:
+            await _start_train_pass(writer, s, now)
+        crops.observe(raw, xyxy, clss, ids, s.roi)
+
+        for c in crossings:
+            # Persist CarEvent with EB/WB
+            writer.car_event(train.train_id, c["track_id"], c["class"], c["direction"], now)
+
+            # Loco crops go to OCR once the locomotive has left the view
+            if c["class"] == "locomotive":
+                crops.mark_counted(train.train_id, c["track_id"])
+
+            # Live update event (now includes EB/WB)
+            await event_queue.put({
+                "event": "count",
+                "train_id": train.train_id,
+                "camera": s.name,
+                "track_id": c["track_id"],
+                "class": c["class"],
+                "direction": c["direction"],     # EB / WB
+                "speed_mph": round(c["speed_mph"], 1),
+                "avg_speed_mph": round(train.avg_speed() or 0.0, 1),
+                "totals": dict(train.counts),
+                "ts": time.time()
+            })
+
+    # Annotated preview, only encoded while someone is watching /stream.mjpg
+    if s.preview.viewers:
+        totals = f"{train.counts.get('locomotive', 0)}L/{train.counts.get('railcar', 0)}R"
+        s.preview.offer(raw, xyxy, clss, ids, s.line_x, s.roi, CLASS_MAP,
+                        f"{s.name} {train.train_id + ' ' + totals if train.active else 'idle'} {s.fps:.1f} fps")
+
+    # Queue the best crops of locomotives that are out of view
+    ending = train.maybe_end()
+    for item in crops.pop_ready(flush_all=ending):
+        await ocr_queue.put(item)
+
+    # Train end?
+    if ending:
+        summary = train.summary()
+        writer.train_end(train.train_id, summary)   # forces a flush of the whole train
+
+        await event_queue.put({
+            "event": "train_end",
+            "train_id": train.train_id,
+            "camera": s.name,
+            "ts": now,
+            "direction": summary["direction"],
+            "final_totals": {
+                "locomotive": summary["locomotive"],
+                "railcar": summary["railcar"]
+            }
+        })
+        # Its last crops are already queued; OCR state for the train can go once they're read
+        ocr_queue.end_train(train.train_id)
+        # reset
+        s.train = s.new_session()  # new instance resets state
+        s.crops = LocoCropCollector()
+        s.reset_tracks = True
+        if s.journal is not None:
+            s.journal.rotate(fresh=True)   # one journal segment per train
+
+    stage_seconds.observe("count", time.perf_counter() - t0)
+
+async def count_stage(results_q: asyncio.Queue, writer: PersistenceWriter):
+    """Counting for all cameras, fed by the inference stage; writes go through the write-behind writer."""
+    while True:
+        s, now, raw, n_det, xyxy, clss, ids, conf = await results_q.get()
+        await count_frame(s, writer, now, raw, n_det, xyxy, clss, ids, conf)
+        startup.first_counted_frame()
+
+def _load_tracking(streams: list):
+    """Model (ultralytics/torch import, weights, warmup) plus each camera's tracker; runs in a thread."""
+    model = load_model()
+    for s in streams:
+        s.tracks = StreamTracker()
+    return model
+
+def _open_camera(s: "CameraStream", stop: threading.Event):
+    import cv2
+    s.open(cv2)
+    # Capture starts right away so there's a fresh frame waiting when the model is ready
+    s.start_capture(stop)
+
+async def tracker_loop(on_commit=None, db_ready=None):
+    """Model load and camera open run concurrently in threads; the DB (db_ready) is only awaited before counting."""
+    cams = load_cameras()
+    ready = threading.Event()
+    streams = camera_streams
+    streams[:] = [CameraStream(c, ready, multi=len(cams) > 1) for c in cams]
+    startup.expect("model", *(f"camera:{s.name}" for s in streams))
+    startup.begin("tracker")
+
+    stop = threading.Event()
+    stages, writer = [], None
     try:
-        while True:
-            # Read frame explicitly in thread
-            ret, raw = await asyncio.to_thread(cam.read)
-            if not ret:
-                # If camera fails, wait a bit and try again or break
-                await asyncio.sleep(0.1)
-                continue
-
-            # Run inference in thread
-            results = await asyncio.to_thread(model.track, raw, tracker="bytetrack.yaml",
-                                conf=CONF, imgsz=IMG_SIZE, persist=True, verbose=False,
-                                device=model.device)
-
-            for r in results:
-                now = time.time()
-
-            has_boxes = r.boxes is not None and len(r.boxes) > 0
-
-            # Train start logic: require a few consecutive "has detections"
-            train.start_buffer.append(1 if has_boxes else 0)
-            if not train.active and sum(train.start_buffer) >= START_FRAMES:
-                train.start()
-                # DB row
-                tp = TrainPass(train_id=train.train_id, start_ts=datetime.now(timezone.utc))
-                db.add(tp); db.commit()
-                await event_queue.put({"event": "train_start", "train_id": train.train_id, "ts": now})
-
-            if has_boxes:
-                train.last_detection_time = now
-                boxes = r.boxes
-                xyxy = boxes.xyxy.cpu().numpy()
-                clss = boxes.cls.cpu().numpy().astype(int)
-                ids = boxes.id
-                if ids is None:
-                    continue
-                ids = ids.cpu().numpy().astype(int)
-
-                for (x1, y1, x2, y2), cls_i, tid in zip(xyxy, clss, ids):
-                    label = CLASS_MAP.get(cls_i, "unknown")
-                    cx = (x1 + x2) / 2.0
-
-                    # Track age
-                    train.track_age[tid] += 1
-
-                    # Keep dx history to estimate train's overall direction later
-                    if tid in train.last_center_x:
-                        dx = cx - train.last_center_x[tid]
-                        train.dx_buffer.append(dx)
-
-                    # Crossing check
-                    if tid in train.last_center_x and train.track_age[tid] >= MIN_TRACK_FRAMES:
-                        prev_cx = train.last_center_x[tid]
-                        crossed = (prev_cx < LINE_X <= cx) or (prev_cx > LINE_X >= cx)
-                        if crossed and tid not in train.counted_ids and label in ("locomotive", "railcar"):
-                            train.counted_ids.add(tid)
-                            train.counts[label] += 1
-
-                            # Per-object direction (EB/WB)
-                            dx = cx - prev_cx
-                            direction_compass = lr_to_compass(dx)
-
-                            # Ensure train is active before logging event
-                            if not train.active:
-                                # Logic duplicated from START_FRAMES check, but inline here to save the event
-                                train.start()
-                                tp = TrainPass(train_id=train.train_id, start_ts=datetime.now(timezone.utc))
-                                db.add(tp); db.commit()
-                                await event_queue.put({"event": "train_start", "train_id": train.train_id, "ts": now})
-
-                            # Persist CarEvent with EB/WB
-                            tp = db.query(TrainPass).filter_by(train_id=train.train_id).one()
-                            ev = CarEvent(train_pass_id=tp.id, track_id=int(tid),
-                                        klass=label, direction=direction_compass)
-                            db.add(ev); db.commit()
-
-                            # Calculate speed
-                            speed_mph = 0.0
-                            
-                            # Only calculate speed if object is fully inside the frame
-                            frame_h, frame_w = raw.shape[:2]
-                            is_fully_inside = (x1 > 1) and (x2 < frame_w - 1)
-
-                            if tid in train.last_ts and is_fully_inside:
-                                dt = now - train.last_ts[tid]
-                                if dt > 0:
-                                    # distance in feet = dx (pixels) / PIXELS_PER_FOOT
-                                    # speed in fps = (dx / PIXELS_PER_FOOT) / dt
-                                    # speed in mph = fps * 0.681818
-                                    # Use absolute dx for speed magnitude
-                                    dist_ft = abs(dx) / PIXELS_PER_FOOT
-                                    fps = dist_ft / dt
-                                    speed_mph = fps * 0.681818
-                                    if speed_mph > 0.1 and speed_mph < 150: # valid range filter
-                                        train.speeds.append(speed_mph)
-
-                            # Queue loco crop for OCR
-                            if label == "locomotive":
-                                x1i, y1i, x2i, y2i = map(int, [x1, y1, x2, y2])
-                                x1i = max(0, x1i); y1i = max(0, y1i)
-                                x2i = min(raw.shape[1], x2i); y2i = min(raw.shape[0], y2i)
-                                crop = raw[y1i:y2i, x1i:x2i].copy()
-                                await ocr_queue.put({
-                                    "train_id": train.train_id,
-                                    "track_id": int(tid),
-                                    "image": crop
-                                })
-
-                            # Calculate current average speed for display
-                            avg_speed = 0.0
-                            if train.speeds:
-                                avg_speed = sum(train.speeds) / len(train.speeds)
-
-                            # Live update event (now includes EB/WB)
-                            await event_queue.put({
-                                "event": "count",
-                                "train_id": train.train_id,
-                                "track_id": int(tid),
-                                "class": label,
-                                "direction": direction_compass,     # EB / WB
-                                "speed_mph": round(speed_mph, 1),
-                                "avg_speed_mph": round(avg_speed, 1),
-                                "totals": dict(train.counts),
-                                "ts": time.time()
-                            })
-
-                    train.last_center_x[tid] = cx
-                    train.last_ts[tid] = now
-
-            # Train end?
-            if train.maybe_end():
-                tp = db.query(TrainPass).filter_by(train_id=train.train_id).one()
-                tp.end_ts = datetime.now(timezone.utc)
-                tp.direction = train.direction()
-                tp.total_locomotives = train.counts.get("locomotive", 0)
-                tp.total_railcars = train.counts.get("railcar", 0)
-                if train.speeds:
-                     tp.avg_speed_mph = sum(train.speeds) / len(train.speeds)
-                db.add(tp); db.commit()
-
-                await event_queue.put({
-                    "event": "train_end",
-                    "train_id": train.train_id,
-                    "ts": now,
-                    "direction": tp.direction,
-                    "final_totals": {
-                        "locomotive": tp.total_locomotives,
-                        "railcar": tp.total_railcars
-                    }
-                })
-                # reset
-                train = TrainSession()  # new instance resets state
+        # Let every thread finish before cleanup, even if one of them failed
+        results = await asyncio.gather(
+            startup.timed("model", asyncio.to_thread(_load_tracking, streams)),
+            *(startup.timed(f"camera:{s.name}", asyncio.to_thread(_open_camera, s, stop)) for s in streams),
+            return_exceptions=True)
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+        model = results[0]
+        print("OpenCV loaded and ready to capture video") # User requested this specific message for OpenCV load/ready
+        print("Camera loaded") # User requested this output
+        if len(streams) > 1:
+            print(f"Cameras: {', '.join(s.name for s in streams)}")
+
+        if db_ready is not None:
+            await db_ready
+
+        # Pipeline: capture threads -> FrameRings -> batched inference -> results_q -> counting/persistence
+        results_q = asyncio.Queue(maxsize=RESULT_QUEUE_SIZE * len(streams))
+        writer = PersistenceWriter(on_commit=on_commit).start()
+        stages = [asyncio.create_task(inference_stage(model, streams, ready, results_q)),
+                  asyncio.create_task(count_stage(results_q, writer))]
+        startup.ready("tracker")
+
+        # Either stage failing takes the whole pipeline down
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            t.result()
+    except asyncio.CancelledError:
+        startup.stopped("tracker")
+        raise
+    except Exception as e:
+        startup.failed("tracker", e)
+        raise
     finally:
-        db.close()
-        cam.release()
\ No newline at end of file
+        for t in stages:
+            t.cancel()
+        stop.set()
+        for s in streams:
+            await asyncio.to_thread(s.close)
+        # Final flush of anything still queued for the DB (and the journal)
+        if writer is not None:
+            await asyncio.to_thread(writer.close)
+        for s in streams:
+            if s.journal is not None:
+                await asyncio.to_thread(s.journal.close)
+        print(f"CPU use: {cpu_meter.report()}")